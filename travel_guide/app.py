@@ -1,12 +1,20 @@
+import os
 import uuid
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 
-from rag import rag
+import metrics
+from rag import rag, rag_stream, cache_stats, preload
 import db
+from serving import answer_result, save_answer, sse
 
 app = Flask(__name__)
 
+# With gunicorn --preload this runs once in the master process, and the forked workers share
+# the loaded index and models; otherwise each worker loads them on its first question
+if os.getenv("PRELOAD", "0") == "1":
+    preload()
+
 
 @app.route("/question", methods=["POST"])
 def handle_question():
@@ -20,21 +28,44 @@ def handle_question():
 
     answer_data = rag(question)
 
-    result = {
-        "conversation_id": conversation_id,
-        "question": question,
-        "answer": answer_data["answer"],
-    }
+    result = answer_result(conversation_id, question, answer_data)
 
-    db.save_conversation(
-        conversation_id=conversation_id,
-        question=question,
-        answer_data=answer_data,
-    )
+    save_answer(conversation_id, question, answer_data)
 
     return jsonify(result)
 
 
+@app.route("/question/stream", methods=["POST"])
+def handle_question_stream():
+    data = request.json
+    question = data["question"]
+
+    if not question:
+        return jsonify({"error": "No question provided"}), 400
+
+    conversation_id = str(uuid.uuid4())
+
+    # Server-sent events: "token" events carry the answer as it is generated, and a final
+    # "done" event the same result /question returns. The conversation is saved once the
+    # answer is complete; it is not saved if the client disconnects before that.
+    def generate():
+        for kind, value in rag_stream(question):
+            if kind == "token":
+                yield sse("token", {"text": value})
+
+        answer_data = value
+        save_answer(conversation_id, question, answer_data)
+
+        yield sse("done", answer_result(conversation_id, question, answer_data))
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        # Keep proxies from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.route("/feedback", methods=["POST"])
 def handle_feedback():
     data = request.json
@@ -45,7 +76,7 @@ def handle_feedback():
         return jsonify({"error": "Invalid input"}), 400
     
 
-    db.save_feedback(
+    db.writer.save_feedback(
         conversation_id=conversation_id,
         feedback=feedback,
     )
@@ -56,5 +87,16 @@ def handle_feedback():
     return jsonify(result)
 
 
+@app.route("/cache/stats", methods=["GET"])
+def handle_cache_stats():
+    return jsonify(cache_stats())
+
+
+@app.route("/metrics", methods=["GET"])
+def handle_metrics():
+    # Stage latencies, token use, cache lookups and errors, for Prometheus to scrape
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
 if __name__ == "__main__":
     app.run(debug=True)
\ No newline at end of file
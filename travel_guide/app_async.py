@@ -0,0 +1,95 @@
+import uuid
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+import metrics
+from rag import rag_async, rag_stream_async, cache_stats
+import db
+from serving import answer_result, save_answer, sse
+
+# Async serving mode: the same API as app.py, served by uvicorn. Requests wait on Groq without
+# holding a worker and database writes are queued, so one process serves many concurrent questions:
+#   uvicorn --host 0.0.0.0 --port 5000 app_async:app
+
+
+async def handle_question(request):
+    data = await request.json()
+    question = data["question"]
+
+    if not question:
+        return JSONResponse({"error": "No question provided"}, status_code=400)
+
+    conversation_id = str(uuid.uuid4())
+
+    answer_data = await rag_async(question)
+
+    result = answer_result(conversation_id, question, answer_data)
+
+    save_answer(conversation_id, question, answer_data)
+
+    return JSONResponse(result)
+
+
+async def handle_question_stream(request):
+    data = await request.json()
+    question = data["question"]
+
+    if not question:
+        return JSONResponse({"error": "No question provided"}, status_code=400)
+
+    conversation_id = str(uuid.uuid4())
+
+    # Same events as /question/stream in app.py
+    async def generate():
+        async for kind, value in rag_stream_async(question):
+            if kind == "token":
+                yield sse("token", {"text": value})
+
+        answer_data = value
+        save_answer(conversation_id, question, answer_data)
+
+        yield sse("done", answer_result(conversation_id, question, answer_data))
+
+    return StreamingResponse(
+        generate(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def handle_feedback(request):
+    data = await request.json()
+    conversation_id = data["conversation_id"]
+    feedback = data["feedback"]
+
+    if not conversation_id or feedback not in [1, -1]:
+        return JSONResponse({"error": "Invalid input"}, status_code=400)
+
+    db.writer.save_feedback(
+        conversation_id=conversation_id,
+        feedback=feedback,
+    )
+
+    result = {
+        "message": f"Feedback received for conversation {conversation_id}: {feedback}"
+    }
+    return JSONResponse(result)
+
+
+async def handle_cache_stats(request):
+    return JSONResponse(cache_stats())
+
+
+async def handle_metrics(request):
+    return Response(metrics.render(), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+
+app = Starlette(routes=[
+    Route("/question", handle_question, methods=["POST"]),
+    Route("/question/stream", handle_question_stream, methods=["POST"]),
+    Route("/feedback", handle_feedback, methods=["POST"]),
+    Route("/cache/stats", handle_cache_stats, methods=["GET"]),
+    Route("/metrics", handle_metrics, methods=["GET"]),
+])
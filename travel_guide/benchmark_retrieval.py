@@ -0,0 +1,163 @@
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+import ingest
+from memory import rss_mb
+
+# Measures search quality and speed on the ground-truth questions, and writes the results as
+# JSON so runs can be compared over time:
+#   python benchmark_retrieval.py --output results/baseline.json
+#   python benchmark_retrieval.py --scale 100 --inverted-index
+# --scale N indexes N copies of travel_data.csv. Copy 0 is the original data, which the
+# ground truth refers to; the other copies mix field values of different documents, so they
+# have the same vocabulary and act as distractors.
+
+
+parser = argparse.ArgumentParser(description="Benchmark search quality and speed")
+parser.add_argument("--target", choices=["index", "segmented", "rag"], default="index",
+                    help="minsearch.Index, minsearch.SegmentedIndex, or rag.minsearch_improved as the app runs it")
+parser.add_argument("--data", default=ingest.SCRIPT_DATA_PATH)
+parser.add_argument("--ground-truth", default=ingest.GROUND_TRUTH_PATH)
+parser.add_argument("--scale", type=int, default=1, help="number of copies of the corpus to index")
+parser.add_argument("--inverted-index", action="store_true", help="prune with posting lists (Index only)")
+parser.add_argument("--num-results", type=int, default=10, help="results per query, the k of hit rate and MRR")
+parser.add_argument("--queries", type=int, default=0, help="number of ground-truth questions to use; 0 for all")
+parser.add_argument("--repeat", type=int, default=3, help="timed passes over the questions")
+parser.add_argument("--label", default="", help="name of this run in the output")
+parser.add_argument("--output", help="JSON file to write; printed when omitted")
+args = parser.parse_args()
+
+if args.target == "rag" and (args.scale != 1 or args.inverted_index):
+    parser.error("--target rag searches the app's own index, so it takes no --scale or --inverted-index")
+
+
+def index_mb(index):
+    # Arrays the index keeps per document and term; the documents themselves are not counted
+    arrays = [index.live, index.df, index.idf, index.column_field]
+    for matrix in (index.matrix, index.counts, getattr(index, "postings", None)):
+        if matrix is not None:
+            arrays += [matrix.data, matrix.indices, matrix.indptr]
+    return sum(array.nbytes for array in arrays) / 2**20
+
+
+def scale_documents(documents, scale, seed=1):
+    rng = random.Random(seed)
+    scaled = list(documents)
+    for copy in range(1, scale):
+        columns = {field: [doc[field] for doc in documents] for field in documents[0] if field != "id"}
+        for values in columns.values():
+            rng.shuffle(values)
+        for i in range(len(documents)):
+            doc = {field: values[i] for field, values in columns.items()}
+            doc["id"] = copy * len(documents) + i + 1
+            scaled.append(doc)
+    return scaled
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+ground_truth = pd.read_csv(args.ground_truth).to_dict(orient="records")
+if args.queries:
+    ground_truth = ground_truth[:args.queries]
+questions = [record["question"] for record in ground_truth]
+
+# Build
+rss_before = rss_mb()
+t0 = time.perf_counter()
+if args.target == "rag":
+    import rag
+    search = rag.minsearch_improved
+    index = rag.search_index().index
+    search(questions[0])
+    n_docs = len(index.docs)
+else:
+    documents = scale_documents(ingest.load_documents(args.data), args.scale)
+    n_docs = len(documents)
+    index = ingest.fit_index(documents, boost_dict=ingest.BOOST, inverted_index=args.inverted_index)
+    searcher = index
+    if args.target == "segmented":
+        import minsearch
+        searcher = minsearch.SegmentedIndex(index)
+
+    def search(query):
+        return searcher.search(query, boost_dict=ingest.BOOST, num_results=args.num_results)
+build_seconds = time.perf_counter() - t0
+memory_mb = rss_mb() - rss_before
+
+# Quality
+hits = 0
+reciprocal_ranks = 0.0
+for record in ground_truth:
+    ids = [doc["id"] for doc in search(record["question"])[:args.num_results]]
+    if record["id"] in ids:
+        hits += 1
+        reciprocal_ranks += 1 / (ids.index(record["id"]) + 1)
+
+# Speed: one query at a time on one thread, so queries per second are per core
+latencies = []
+for _ in range(args.repeat):
+    for question in questions:
+        t0 = time.perf_counter()
+        search(question)
+        latencies.append(time.perf_counter() - t0)
+latencies = np.array(latencies)
+
+results = {
+    "label": args.label,
+    "timestamp": datetime.now(timezone.utc).isoformat(),
+    "commit": git_commit(),
+    "config": {
+        "target": args.target,
+        "scale": args.scale,
+        "inverted_index": args.inverted_index,
+        "num_results": args.num_results,
+        "queries": len(questions),
+        "repeat": args.repeat,
+    },
+    "corpus": {"docs": n_docs, "columns": int(index.matrix.shape[1])},
+    "build": {"seconds": build_seconds, "memory_mb": memory_mb, "index_mb": index_mb(index)},
+    "quality": {"hit_rate": hits / len(ground_truth), "mrr": reciprocal_ranks / len(ground_truth)},
+    "latency_ms": {
+        "mean": latencies.mean() * 1000,
+        "p50": np.percentile(latencies, 50) * 1000,
+        "p95": np.percentile(latencies, 95) * 1000,
+        "p99": np.percentile(latencies, 99) * 1000,
+    },
+    "qps_per_core": len(latencies) / latencies.sum(),
+}
+
+if args.target == "index":
+    # The offline evaluation path: every question in one search_batch call
+    t0 = time.perf_counter()
+    index.search_batch(questions, boost_dict=ingest.BOOST, num_results=args.num_results)
+    results["batch_qps_per_core"] = len(questions) / (time.perf_counter() - t0)
+
+print(
+    f"{n_docs} docs, built in {build_seconds:.2f}s ({results['build']['index_mb']:.1f} MB of index arrays); "
+    f"hit rate {results['quality']['hit_rate']:.3f}, MRR {results['quality']['mrr']:.3f}; "
+    f"p50 {results['latency_ms']['p50']:.2f}ms, p99 {results['latency_ms']['p99']:.2f}ms, "
+    f"{results['qps_per_core']:.0f} queries/s per core",
+    file=sys.stderr,
+)
+
+if args.output:
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+else:
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,293 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from time import time
+
+import numpy as np
+
+# "memory" keeps answers per process, "sqlite" shares them between the workers of one host
+ANSWER_CACHE = os.getenv("ANSWER_CACHE", "memory")
+ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH", "./data/answer_cache.sqlite")
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))
+# Seconds an answer stays valid; 0 keeps answers until they are evicted or the corpus changes
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "86400"))
+
+# Reuse answers to paraphrased questions; needs sentence-transformers
+SEMANTIC_CACHE = os.getenv("SEMANTIC_CACHE", "0") == "1"
+# Cosine similarity from which two questions count as the same. Questions that only differ in
+# the destination ("what to eat in Rome" / "in Paris") score high too, so keep this strict.
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.9"))
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "1000"))
+
+
+def normalize_question(question):
+    # Case, punctuation and extra whitespace do not change what is being asked
+    return " ".join(re.sub(r"[^\w\s]", " ", question.lower()).split())
+
+
+def cache_key(question, model, corpus_version):
+    text = "\n".join([model, corpus_version, normalize_question(question)])
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class MemoryBackend:
+    """
+    LRU cache of answers in this process, with entries expiring after ttl seconds.
+    """
+
+    def __init__(self, max_size=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            created, value = entry
+            if self.ttl and time() - created > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteBackend:
+    """
+    LRU cache of answers in a SQLite file, shared by every process that opens it.
+
+    Several caches can share one file, each in its own table.
+    """
+
+    def __init__(self, path=ANSWER_CACHE_PATH, max_size=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL,
+                 table="answers"):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.table = table
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {self.table} (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_last_used ON {self.table} (last_used)")
+
+    def _connect(self):
+        # A connection per call: sqlite3 connections cannot be shared between threads
+        return sqlite3.connect(self.path, timeout=5)
+
+    def get(self, key):
+        now = time()
+        conn = self._connect()
+        try:
+            with conn:
+                row = conn.execute(f"SELECT value, created FROM {self.table} WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    return None
+                value, created = row
+                if self.ttl and now - created > self.ttl:
+                    conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                    return None
+                conn.execute(f"UPDATE {self.table} SET last_used = ? WHERE key = ?", (now, key))
+            return json.loads(value)
+        finally:
+            conn.close()
+
+    def set(self, key, value):
+        now = time()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    f"INSERT OR REPLACE INTO {self.table} (key, value, created, last_used) VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(value), now, now),
+                )
+                conn.execute(
+                    f"DELETE FROM {self.table} WHERE key IN "
+                    f"(SELECT key FROM {self.table} ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                    (self.max_size,),
+                )
+        finally:
+            conn.close()
+
+    def __len__(self):
+        conn = self._connect()
+        try:
+            return conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        finally:
+            conn.close()
+
+
+class AnswerCache:
+    """
+    Caches answer_data by question, model and corpus version, and counts hits and misses.
+
+    The corpus version is part of the key, so answers given before the documents changed
+    are never served again; they age out of the backend.
+    """
+
+    name = "exact"
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, question, model, corpus_version):
+        value = self.backend.get(cache_key(question, model, corpus_version))
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, question, model, corpus_version, answer_data):
+        self.backend.set(cache_key(question, model, corpus_version), answer_data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": len(self.backend),
+        }
+
+
+class SemanticCache:
+    """
+    Reuses the answer to an earlier question whose embedding is close enough to a new one's.
+
+    Questions are embedded once, and the embeddings of cached questions are kept as rows of
+    one matrix, so a lookup is a single matrix-vector product. When the cache is full, the
+    least recently used entry is replaced; entries expire after ttl seconds. All entries are
+    dropped when the corpus version changes.
+
+    Args:
+        encode (callable): Maps a list of texts to an array of L2-normalized embeddings.
+        threshold (float): Cosine similarity from which a cached answer is reused.
+        max_size (int): Maximum number of cached answers.
+        ttl (float): Seconds an answer stays valid; 0 keeps answers until they are evicted.
+    """
+
+    name = "semantic"
+
+    def __init__(self, encode, threshold=SEMANTIC_CACHE_THRESHOLD, max_size=SEMANTIC_CACHE_SIZE,
+                 ttl=ANSWER_CACHE_TTL):
+        self.encode = encode
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._embeddings = None
+        self._models = [None] * max_size
+        self._answers = [None] * max_size
+        self._created = np.zeros(max_size)
+        self._last_used = np.zeros(max_size)
+        self._corpus_version = None
+        self._lock = threading.Lock()
+        # A miss is followed by set() for the same question, so its embedding is kept
+        self._embed = lru_cache(maxsize=256)(self._embed_uncached)
+
+    def _embed_uncached(self, normalized_question):
+        return np.asarray(self.encode([normalized_question]), dtype=np.float32)[0]
+
+    def _invalidate_if_stale(self, corpus_version):
+        if corpus_version != self._corpus_version:
+            self._corpus_version = corpus_version
+            self._models = [None] * self.max_size
+            self._answers = [None] * self.max_size
+            self._created[:] = 0
+            self._last_used[:] = 0
+
+    def get(self, question, model, corpus_version):
+        embedding = self._embed(normalize_question(question))
+        now = time()
+
+        with self._lock:
+            self._invalidate_if_stale(corpus_version)
+            answer_data = None
+            if self._embeddings is not None:
+                scores = self._embeddings @ embedding
+                valid = np.array([entry_model == model for entry_model in self._models])
+                if self.ttl:
+                    valid &= now - self._created <= self.ttl
+                scores[~valid] = -np.inf
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    self._last_used[best] = now
+                    answer_data = self._answers[best]
+
+            if answer_data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return answer_data
+
+    def set(self, question, model, corpus_version, answer_data):
+        embedding = self._embed(normalize_question(question))
+        now = time()
+
+        with self._lock:
+            self._invalidate_if_stale(corpus_version)
+            if self._embeddings is None:
+                self._embeddings = np.zeros((self.max_size, len(embedding)), dtype=np.float32)
+
+            # Free and expired slots have the oldest last_used, so they are reused first
+            last_used = self._last_used.copy()
+            if self.ttl:
+                last_used[now - self._created > self.ttl] = 0
+            slot = int(np.argmin(last_used))
+
+            self._embeddings[slot] = embedding
+            self._models[slot] = model
+            self._answers[slot] = answer_data
+            self._created[slot] = now
+            self._last_used[slot] = now
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": sum(answer is not None for answer in self._answers),
+        }
+
+
+def create_answer_cache(kind=ANSWER_CACHE):
+    if kind == "off":
+        return None
+    if kind == "sqlite":
+        return AnswerCache(SQLiteBackend())
+    if kind == "memory":
+        return AnswerCache(MemoryBackend())
+    raise ValueError(f"Unknown ANSWER_CACHE {kind!r}, expected 'memory', 'sqlite' or 'off'")
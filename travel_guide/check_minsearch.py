@@ -0,0 +1,144 @@
+import argparse
+import copy
+import importlib.util
+import os
+import random
+import sys
+
+import numpy as np
+import pandas as pd
+from sklearn.metrics.pairwise import cosine_similarity
+
+import ingest
+import minsearch
+
+# Checks that minsearch still ranks and scores documents like the original implementation,
+# which is kept in notebooks/minsearch.py:
+#   python check_minsearch.py
+#   python check_minsearch.py --queries 100 --num-results 5
+# Every ground-truth question is searched, with the app's boosts and without any, on an
+# Index with and without inverted_index, on an Index after add/update/delete and refresh(),
+# and on a SegmentedIndex after the same changes and a merge(). The reference is the original
+# Index fitted on the documents each of them ends up with. Documents with the same score may
+# come in either order, so results match when their scores match position by position and
+# every returned document has the score the reference gives it. Exits with 1 on a mismatch.
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "notebooks", "minsearch.py")
+
+# A term of no document in the data, so the changes below add vocabulary
+NEW_TERM = "zanzibarite"
+
+parser = argparse.ArgumentParser(description="Check minsearch results against the original implementation")
+parser.add_argument("--data", default=ingest.SCRIPT_DATA_PATH)
+parser.add_argument("--ground-truth", default=ingest.GROUND_TRUTH_PATH)
+parser.add_argument("--num-results", type=int, default=10, help="results per query")
+parser.add_argument("--queries", type=int, default=0, help="number of ground-truth questions to use; 0 for all")
+parser.add_argument("--seed", type=int, default=1)
+args = parser.parse_args()
+
+
+def load_baseline():
+    spec = importlib.util.spec_from_file_location("minsearch_baseline", BASELINE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def baseline_scores(index, query, boost_dict):
+    # The scores the original Index.search() ranks by, which it does not return
+    scores = np.zeros(len(index.docs))
+    for field in index.text_fields:
+        query_vec = index.vectorizers[field].transform([query])
+        scores += cosine_similarity(query_vec, index.text_matrices[field]).ravel() * boost_dict.get(field, 1)
+    return scores
+
+
+def change_documents(searcher, documents, rng):
+    """Deletes, updates and adds documents through searcher, and returns the documents it ends up with."""
+    documents = {doc["id"]: dict(doc) for doc in documents}
+    ids = sorted(documents)
+    picked = rng.sample(ids, 30)
+
+    for doc_id in picked[:10]:
+        searcher.delete(doc_id)
+        del documents[doc_id]
+
+    for doc_id in picked[10:20]:
+        doc = dict(documents[rng.choice(ids[:len(ids) // 2])], id=doc_id)
+        doc["travel_tip"] = f"{doc['travel_tip']} Ask for {NEW_TERM}."
+        searcher.update(doc_id, doc)
+        documents[doc_id] = doc
+
+    fields = [field for field in next(iter(documents.values())) if field != "id"]
+    added = []
+    for i in range(20):
+        sources = [documents[rng.choice(list(documents))] for _ in fields]
+        doc = {field: source[field] for field, source in zip(fields, sources)}
+        doc["id"] = ids[-1] + i + 1
+        added.append(doc)
+    added[0]["destination"] = f"{added[0]['destination']} {NEW_TERM.title()}"
+    searcher.add(added)
+    documents.update((doc["id"], doc) for doc in added)
+
+    return list(documents.values())
+
+
+def compare(searcher, reference, queries, boost_dict):
+    """Counts the queries whose results on searcher differ from the reference's."""
+    mismatches = 0
+    for query in queries:
+        scores = baseline_scores(reference, query, boost_dict)
+        # Same order as the original: by score, and documents scoring 0 are not returned
+        rows = [row for row in np.argsort(-scores, kind="stable")[:args.num_results] if scores[row] > 0]
+        expected = scores[rows]
+        reference_scores = {reference.docs[row]["id"]: scores[row] for row in range(len(scores))}
+
+        ids = [doc["id"] for doc in searcher.search(query, boost_dict=boost_dict, num_results=args.num_results)]
+        actual = searcher.field_scores(query, ids, boost_dict=boost_dict).sum(axis=1)
+
+        if (
+            len(ids) != len(rows)
+            or not np.allclose(actual, expected)
+            or not np.allclose(actual, [reference_scores.get(doc_id, np.nan) for doc_id in ids])
+        ):
+            mismatches += 1
+    return mismatches
+
+
+baseline = load_baseline()
+questions = pd.read_csv(args.ground_truth)["question"].tolist()
+if args.queries:
+    questions = questions[:args.queries]
+documents = ingest.load_documents(args.data)
+
+scenarios = []
+for inverted_index in (False, True):
+    name = "inverted index" if inverted_index else "index"
+    index = ingest.fit_index(documents, boost_dict=ingest.BOOST, inverted_index=inverted_index)
+    text_fields = index.text_fields
+    reference = baseline.Index(text_fields, ["id"]).fit(documents)
+    scenarios.append((name, index, reference, questions))
+
+    # The query with the new term only matches documents added or updated by change_documents
+    changed_questions = questions + [f"Where can I find {NEW_TERM}?"]
+
+    updated = copy.deepcopy(index)
+    updated_documents = change_documents(updated, documents, random.Random(args.seed))
+    updated.refresh()
+    updated_reference = baseline.Index(text_fields, ["id"]).fit(updated_documents)
+    scenarios.append((f"{name} after add/update/delete", updated, updated_reference, changed_questions))
+
+    segmented = minsearch.SegmentedIndex(copy.deepcopy(index))
+    segmented_documents = change_documents(segmented, documents, random.Random(args.seed))
+    segmented.merge()
+    segmented_reference = baseline.Index(text_fields, ["id"]).fit(segmented_documents)
+    scenarios.append((f"segmented {name} after merge", segmented, segmented_reference, changed_questions))
+
+failed = False
+for name, searcher, scenario_reference, scenario_questions in scenarios:
+    for boost_name, boost_dict in (("boosted", ingest.BOOST), ("unboosted", {})):
+        mismatches = compare(searcher, scenario_reference, scenario_questions, boost_dict)
+        failed |= mismatches > 0
+        print(f"{name}, {boost_name}: {mismatches} of {len(scenario_questions)} queries differ")
+
+sys.exit(1 if failed else 0)
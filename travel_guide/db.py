@@ -1,17 +1,39 @@
+import atexit
+import logging
 import os
+import threading
+import time
+from contextlib import contextmanager
 import psycopg2
-from psycopg2.extras import DictCursor
+from psycopg2.extras import DictCursor, execute_values
+from psycopg2.pool import ThreadedConnectionPool
 from datetime import datetime, timezone
 from zoneinfo import ZoneInfo
 
+import metrics
+from lazy import Lazy
+
+logger = logging.getLogger(__name__)
+
 RUN_TIMEZONE_CHECK = os.getenv('RUN_TIMEZONE_CHECK', '1') == '1'
+RUN_MIGRATIONS = os.getenv('RUN_MIGRATIONS', '1') == '1'
 
 TZ_INFO = os.getenv("TZ", "Europe/Berlin")
 tz = ZoneInfo(TZ_INFO)
 
+# Connections kept per process; callers wait for a free one instead of opening more
+POOL_MIN_SIZE = int(os.getenv("POSTGRES_POOL_MIN_SIZE", "1"))
+POOL_MAX_SIZE = int(os.getenv("POSTGRES_POOL_MAX_SIZE", "5"))
+# Connections idle for longer than this are pinged before they are handed out
+POOL_CHECK_AFTER = float(os.getenv("POSTGRES_POOL_CHECK_AFTER", "30"))
 
-def get_db_connection():
-    return psycopg2.connect(
+# The buffered writer flushes once this many rows are waiting, or every WRITE_FLUSH_INTERVAL seconds
+WRITE_BATCH_SIZE = int(os.getenv("POSTGRES_WRITE_BATCH_SIZE", "50"))
+WRITE_FLUSH_INTERVAL = float(os.getenv("POSTGRES_WRITE_FLUSH_INTERVAL", "1.0"))
+
+
+def connection_params():
+    return dict(
         host=os.getenv("POSTGRES_HOST", "postgres"),
         database=os.getenv("POSTGRES_DB", "travel_assistant"),
         user=os.getenv("POSTGRES_USER", "your_username"),
@@ -19,9 +41,72 @@ def get_db_connection():
     )
 
 
-def init_db():
-    conn = get_db_connection()
+def get_db_connection():
+    return psycopg2.connect(**connection_params())
+
+
+_pool = None
+_pool_pid = None
+_pool_slots = None
+_pool_lock = threading.Lock()
+_last_used = {}
+
+
+def get_pool():
+    global _pool, _pool_pid, _pool_slots
+    with _pool_lock:
+        # Connections must not be shared across fork, so every gunicorn worker gets its own pool
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadedConnectionPool(POOL_MIN_SIZE, POOL_MAX_SIZE, **connection_params())
+            _pool_pid = os.getpid()
+            _pool_slots = threading.BoundedSemaphore(POOL_MAX_SIZE)
+            _last_used.clear()
+        return _pool, _pool_slots
+
+
+def is_healthy(conn):
+    if conn.closed:
+        return False
+    # Connections the pool has not handed out yet were just opened
+    if time.monotonic() - _last_used.get(id(conn), time.monotonic()) < POOL_CHECK_AFTER:
+        return True
     try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+@contextmanager
+def db_connection():
+    # Borrows a pooled connection; reads and unfinished writes are rolled back when it is returned
+    pool, slots = get_pool()
+    with slots:
+        conn = pool.getconn()
+        while not is_healthy(conn):
+            _last_used.pop(id(conn), None)
+            pool.putconn(conn, close=True)
+            conn = pool.getconn()
+
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            if not broken and not conn.closed:
+                conn.rollback()
+                _last_used[id(conn)] = time.monotonic()
+            else:
+                _last_used.pop(id(conn), None)
+            pool.putconn(conn, close=broken or bool(conn.closed))
+
+
+def init_db():
+    with db_connection() as conn:
         with conn.cursor() as cur:
             cur.execute("DROP TABLE IF EXISTS feedback")
             cur.execute("DROP TABLE IF EXISTS conversations")
@@ -33,6 +118,8 @@ def init_db():
                     answer TEXT NOT NULL,
                     model_used TEXT NOT NULL,
                     response_time FLOAT NOT NULL,
+                    time_to_first_token FLOAT,
+                    tokens_per_second FLOAT,
                     relevance TEXT NOT NULL,
                     relevance_explanation TEXT NOT NULL,
                     prompt_tokens INTEGER NOT NULL,
@@ -42,6 +129,7 @@ def init_db():
                     eval_completion_tokens INTEGER NOT NULL,
                     eval_total_tokens INTEGER NOT NULL,
                     openai_cost FLOAT NOT NULL,
+                    judge_time FLOAT,
                     timestamp TIMESTAMP WITH TIME ZONE NOT NULL
                 )
             """)
@@ -54,67 +142,247 @@ def init_db():
                 )
             """)
         conn.commit()
-    finally:
-        conn.close()
 
 
-def save_conversation(conversation_id, question, answer_data, timestamp=None):
-    if timestamp is None:
-        timestamp = datetime.now(tz)
+# Columns added since init_db first created the tables; every statement must be safe to repeat
+MIGRATIONS = [
+    "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS time_to_first_token FLOAT",
+    "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS tokens_per_second FLOAT",
+    "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS judge_time FLOAT",
+]
 
-    conn = get_db_connection()
-    try:
+
+def migrate_db():
+    # Brings tables created by an older init_db up to date, keeping their rows
+    with db_connection() as conn:
         with conn.cursor() as cur:
-            cur.execute(
-                """
-                INSERT INTO conversations 
-                (id, question, answer, model_used, response_time, relevance, 
-                relevance_explanation, prompt_tokens, completion_tokens, total_tokens, 
-                eval_prompt_tokens, eval_completion_tokens, eval_total_tokens, openai_cost, timestamp)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """,
-                (
-                    conversation_id,
-                    question,
-                    answer_data["answer"],
-                    answer_data["model_used"],
-                    answer_data["response_time"],
-                    answer_data["relevance"],
-                    answer_data["relevance_explanation"],
-                    answer_data["prompt_tokens"],
-                    answer_data["completion_tokens"],
-                    answer_data["total_tokens"],
-                    answer_data["eval_prompt_tokens"],
-                    answer_data["eval_completion_tokens"],
-                    answer_data["eval_total_tokens"],
-                    answer_data["openai_cost"],
-                    timestamp
-                ),
-            )
+            for statement in MIGRATIONS:
+                cur.execute(statement)
         conn.commit()
-    finally:
-        conn.close()
 
 
-def save_feedback(conversation_id, feedback, timestamp=None):
+# Runs once per process: at import, or before the first write if the database was not
+# reachable then. A failed migration is tried again on the next write.
+schema_migrated = Lazy(migrate_db)
+
+
+INSERT_CONVERSATIONS = """
+    INSERT INTO conversations 
+    (id, question, answer, model_used, response_time, time_to_first_token, tokens_per_second,
+    relevance, relevance_explanation, prompt_tokens, completion_tokens, total_tokens, 
+    eval_prompt_tokens, eval_completion_tokens, eval_total_tokens, openai_cost, timestamp)
+    VALUES %s
+"""
+
+INSERT_FEEDBACK = "INSERT INTO feedback (conversation_id, feedback, timestamp) VALUES %s"
+
+# judge_time is cast since a batch of failed judgements has only NULLs there, which VALUES types as text
+UPDATE_RELEVANCE = """
+    UPDATE conversations AS c
+    SET relevance = v.relevance, relevance_explanation = v.relevance_explanation,
+    eval_prompt_tokens = v.eval_prompt_tokens, eval_completion_tokens = v.eval_completion_tokens,
+    eval_total_tokens = v.eval_total_tokens, openai_cost = c.openai_cost + v.eval_cost,
+    judge_time = v.judge_time::float
+    FROM (VALUES %s) AS v (id, relevance, relevance_explanation, eval_prompt_tokens,
+    eval_completion_tokens, eval_total_tokens, eval_cost, judge_time)
+    WHERE c.id = v.id
+"""
+
+
+def conversation_row(conversation_id, question, answer_data, timestamp=None):
     if timestamp is None:
         timestamp = datetime.now(tz)
 
-    conn = get_db_connection()
-    try:
+    return (
+        conversation_id,
+        question,
+        answer_data["answer"],
+        answer_data["model_used"],
+        answer_data["response_time"],
+        answer_data["time_to_first_token"],
+        answer_data["tokens_per_second"],
+        answer_data["relevance"],
+        answer_data["relevance_explanation"],
+        answer_data["prompt_tokens"],
+        answer_data["completion_tokens"],
+        answer_data["total_tokens"],
+        answer_data["eval_prompt_tokens"],
+        answer_data["eval_completion_tokens"],
+        answer_data["eval_total_tokens"],
+        answer_data["openai_cost"],
+        timestamp
+    )
+
+
+def feedback_row(conversation_id, feedback, timestamp=None):
+    if timestamp is None:
+        timestamp = datetime.now(tz)
+
+    return (conversation_id, feedback, timestamp)
+
+
+def relevance_row(evaluation):
+    return (
+        evaluation["conversation_id"],
+        evaluation["relevance"],
+        evaluation["relevance_explanation"],
+        evaluation["eval_prompt_tokens"],
+        evaluation["eval_completion_tokens"],
+        evaluation["eval_total_tokens"],
+        evaluation["eval_cost"],
+        evaluation["judge_time"],
+    )
+
+
+WRITES = (
+    ("conversations", INSERT_CONVERSATIONS),
+    ("feedback", INSERT_FEEDBACK),
+    ("relevance", UPDATE_RELEVANCE),
+)
+
+# Errors caused by the rows themselves, such as feedback for an unknown conversation; the
+# same rows would fail again on a retry
+ROW_ERRORS = (psycopg2.IntegrityError, psycopg2.DataError)
+
+
+@metrics.timed("db_write")
+def write_rows(conversations=(), feedback=(), relevance=()):
+    # One transaction; conversations go first, since feedback and relevance updates refer to them
+    schema_migrated()
+    rows = {"conversations": conversations, "feedback": feedback, "relevance": relevance}
+    with db_connection() as conn:
         with conn.cursor() as cur:
-            cur.execute(
-                "INSERT INTO feedback (conversation_id, feedback, timestamp) VALUES (%s, %s, COALESCE(%s, CURRENT_TIMESTAMP))",
-                (conversation_id, feedback, timestamp),
-            )
+            for table, sql in WRITES:
+                if rows[table]:
+                    execute_values(cur, sql, rows[table], page_size=len(rows[table]))
         conn.commit()
-    finally:
-        conn.close()
+
+
+@metrics.timed("db_write")
+def write_rows_one_by_one(conversations=(), feedback=(), relevance=()):
+    """
+    Writes the rows like write_rows(), but each under its own savepoint, so that rows failing
+    with one of ROW_ERRORS are logged and skipped while the others are written.
+
+    Returns:
+        int: Number of rows skipped.
+    """
+    schema_migrated()
+    rows = {"conversations": conversations, "feedback": feedback, "relevance": relevance}
+    skipped = 0
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            for table, sql in WRITES:
+                for row in rows[table]:
+                    cur.execute("SAVEPOINT write_row")
+                    try:
+                        execute_values(cur, sql, [row])
+                    except ROW_ERRORS as e:
+                        cur.execute("ROLLBACK TO SAVEPOINT write_row")
+                        logger.error("Dropping a %s row that cannot be written: %s", table, str(e).strip())
+                        skipped += 1
+                    else:
+                        cur.execute("RELEASE SAVEPOINT write_row")
+        conn.commit()
+    return skipped
+
+
+def save_conversation(conversation_id, question, answer_data, timestamp=None):
+    write_rows(conversations=[conversation_row(conversation_id, question, answer_data, timestamp)])
+
+
+def save_feedback(conversation_id, feedback, timestamp=None):
+    write_rows(feedback=[feedback_row(conversation_id, feedback, timestamp)])
+
+
+def update_relevance(evaluations):
+    # Written back by the relevance judge once it has evaluated a batch of conversations
+    write_rows(relevance=[relevance_row(evaluation) for evaluation in evaluations])
+
+
+class BufferedWriter:
+    """
+    Coalesces conversation, feedback and relevance writes into multi-row batches.
+
+    The save_* and update_relevance methods only queue rows and return at once. A background
+    thread writes everything queued in one transaction once WRITE_BATCH_SIZE rows are waiting
+    or every WRITE_FLUSH_INTERVAL seconds, and once more when the process exits. If a row
+    itself cannot be written (an integrity or data error), the batch is retried row by row
+    and only the failing rows are dropped. Rows of a flush that failed otherwise, such as
+    when the database is unreachable, are kept for the next one, up to max_pending rows.
+    """
+
+    def __init__(self, batch_size=WRITE_BATCH_SIZE, flush_interval=WRITE_FLUSH_INTERVAL, max_pending=None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending or 100 * batch_size
+        self._pending = {"conversations": [], "feedback": [], "relevance": []}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flush_requested = threading.Event()
+        self._thread = None
+
+    def save_conversation(self, conversation_id, question, answer_data, timestamp=None):
+        self._add("conversations", [conversation_row(conversation_id, question, answer_data, timestamp)])
+
+    def save_feedback(self, conversation_id, feedback, timestamp=None):
+        self._add("feedback", [feedback_row(conversation_id, feedback, timestamp)])
+
+    def update_relevance(self, evaluations):
+        self._add("relevance", [relevance_row(evaluation) for evaluation in evaluations])
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending = self._pending
+                self._pending = {table: [] for table in pending}
+            if not any(pending.values()):
+                return
+
+            try:
+                try:
+                    write_rows(**pending)
+                except ROW_ERRORS:
+                    # A bad row must not hold back the others: write them one by one
+                    write_rows_one_by_one(**pending)
+            except Exception:
+                # Connection errors and the like: the rows are fine, so they are kept for the next flush
+                logger.exception("Writing %d buffered rows failed", sum(map(len, pending.values())))
+                self._requeue(pending)
+
+    def _add(self, table, rows):
+        with self._lock:
+            self._pending[table].extend(rows)
+            full = sum(map(len, self._pending.values())) >= self.batch_size
+            if self._thread is None:
+                # Started on first use, so gunicorn workers each get their own thread
+                self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+        if full:
+            self._flush_requested.set()
+
+    def _requeue(self, pending):
+        with self._lock:
+            for table, rows in pending.items():
+                self._pending[table][:0] = rows
+                overflow = len(self._pending[table]) - self.max_pending
+                if overflow > 0:
+                    logger.error("Dropping %d buffered %s rows", overflow, table)
+                    del self._pending[table][:overflow]
+
+    def _run(self):
+        while True:
+            self._flush_requested.wait(self.flush_interval)
+            self._flush_requested.clear()
+            self.flush()
+
+
+writer = BufferedWriter()
 
 
 def get_recent_conversations(limit=5, relevance=None):
-    conn = get_db_connection()
-    try:
+    with db_connection() as conn:
         with conn.cursor(cursor_factory=DictCursor) as cur:
             query = """
                 SELECT c.*, f.feedback
@@ -127,13 +395,10 @@ def get_recent_conversations(limit=5, relevance=None):
 
             cur.execute(query, (limit,))
             return cur.fetchall()
-    finally:
-        conn.close()
 
 
 def get_feedback_stats():
-    conn = get_db_connection()
-    try:
+    with db_connection() as conn:
         with conn.cursor(cursor_factory=DictCursor) as cur:
             cur.execute("""
                 SELECT 
@@ -142,58 +407,61 @@ def get_feedback_stats():
                 FROM feedback
             """)
             return cur.fetchone()
-    finally:
-        conn.close()
 
 
 def check_timezone():
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SHOW timezone;")
-            db_timezone = cur.fetchone()[0]
-            print(f"Database timezone: {db_timezone}")
+    with db_connection() as conn:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SHOW timezone;")
+                db_timezone = cur.fetchone()[0]
+                print(f"Database timezone: {db_timezone}")
 
-            cur.execute("SELECT current_timestamp;")
-            db_time_utc = cur.fetchone()[0]
-            print(f"Database current time (UTC): {db_time_utc}")
+                cur.execute("SELECT current_timestamp;")
+                db_time_utc = cur.fetchone()[0]
+                print(f"Database current time (UTC): {db_time_utc}")
 
-            db_time_local = db_time_utc.astimezone(tz)
-            print(f"Database current time ({TZ_INFO}): {db_time_local}")
+                db_time_local = db_time_utc.astimezone(tz)
+                print(f"Database current time ({TZ_INFO}): {db_time_local}")
 
-            py_time = datetime.now(tz)
-            print(f"Python current time: {py_time}")
+                py_time = datetime.now(tz)
+                print(f"Python current time: {py_time}")
 
-            # Use py_time instead of tz for insertion
-            cur.execute("""
-                INSERT INTO conversations 
-                (id, question, answer, model_used, response_time, relevance, 
-                relevance_explanation, prompt_tokens, completion_tokens, total_tokens, 
-                eval_prompt_tokens, eval_completion_tokens, eval_total_tokens, openai_cost, timestamp)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                RETURNING timestamp;
-            """, 
-            ('test', 'test question', 'test answer', 'test model', 0.0, 0.0, 
-             'test explanation', 0, 0, 0, 0, 0, 0, 0.0, py_time))
-
-            inserted_time = cur.fetchone()[0]
-            print(f"Inserted time (UTC): {inserted_time}")
-            print(f"Inserted time ({TZ_INFO}): {inserted_time.astimezone(tz)}")
-
-            cur.execute("SELECT timestamp FROM conversations WHERE id = 'test';")
-            selected_time = cur.fetchone()[0]
-            print(f"Selected time (UTC): {selected_time}")
-            print(f"Selected time ({TZ_INFO}): {selected_time.astimezone(tz)}")
-
-            # Clean up the test entry
-            cur.execute("DELETE FROM conversations WHERE id = 'test';")
-            conn.commit()
-    except Exception as e:
-        print(f"An error occurred: {e}")
-        conn.rollback()
-    finally:
-        conn.close()
+                # Use py_time instead of tz for insertion
+                cur.execute("""
+                    INSERT INTO conversations 
+                    (id, question, answer, model_used, response_time, relevance, 
+                    relevance_explanation, prompt_tokens, completion_tokens, total_tokens, 
+                    eval_prompt_tokens, eval_completion_tokens, eval_total_tokens, openai_cost, timestamp)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    RETURNING timestamp;
+                """, 
+                ('test', 'test question', 'test answer', 'test model', 0.0, 0.0, 
+                 'test explanation', 0, 0, 0, 0, 0, 0, 0.0, py_time))
 
+                inserted_time = cur.fetchone()[0]
+                print(f"Inserted time (UTC): {inserted_time}")
+                print(f"Inserted time ({TZ_INFO}): {inserted_time.astimezone(tz)}")
+
+                cur.execute("SELECT timestamp FROM conversations WHERE id = 'test';")
+                selected_time = cur.fetchone()[0]
+                print(f"Selected time (UTC): {selected_time}")
+                print(f"Selected time ({TZ_INFO}): {selected_time.astimezone(tz)}")
+
+                # Clean up the test entry
+                cur.execute("DELETE FROM conversations WHERE id = 'test';")
+                conn.commit()
+        except Exception as e:
+            print(f"An error occurred: {e}")
+            conn.rollback()
+
+
+if RUN_MIGRATIONS:
+    try:
+        schema_migrated()
+    except psycopg2.Error as e:
+        logger.warning("Database migrations did not run (%s); they are retried before the first write",
+                       str(e).strip())
 
 if RUN_TIMEZONE_CHECK:
     check_timezone()
\ No newline at end of file
@@ -2,6 +2,7 @@ import os
 from dotenv import load_dotenv
 
 os.environ['RUN_TIMEZONE_CHECK'] = '0'
+os.environ['RUN_MIGRATIONS'] = '0'
 
 from db import init_db
 
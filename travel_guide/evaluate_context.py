@@ -0,0 +1,68 @@
+import argparse
+import re
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+import rag
+
+# Compares the budgeted context of rag.build_prompt with the full one it replaced (every field
+# of every result) on the questions of rag-eval-llama70b.csv:
+#   python evaluate_context.py                    estimated prompt tokens and answer support
+#   python evaluate_context.py --judge 50         also answer and judge 50 questions both ways
+# Answer support is the share of the words of the recorded answers (given with the full
+# context) that are still in the budgeted context.
+
+parser = argparse.ArgumentParser(description="Compare budgeted and full prompts")
+parser.add_argument("--data", default="../data/rag-eval-llama70b.csv")
+parser.add_argument("--budget", type=int, default=rag.CONTEXT_TOKEN_BUDGET, help="context token budget")
+parser.add_argument("--judge", type=int, default=0, help="questions to answer and judge with both prompts")
+args = parser.parse_args()
+
+full_entry_template = "\n".join(f"{field}: {{{field}}}" for field in ["destination"] + rag.context_fields)
+
+
+def build_full_prompt(query, search_results):
+    context = "".join(full_entry_template.format(**doc) + "\n\n" for doc in search_results)
+    return rag.prompt_template.format(question=query, context=context).strip()
+
+
+def words(text):
+    return {word for word in re.findall(r"\w+", str(text).lower()) if len(word) > 3}
+
+
+df = pd.read_csv(args.data)
+
+full_tokens = []
+budgeted_tokens = []
+support = []
+prompts = []
+for question, answer in zip(df["question"], df["answer"]):
+    search_results = rag.minsearch_improved(question)
+    full = build_full_prompt(question, search_results)
+    budgeted = rag.build_prompt(question, search_results, budget=args.budget)
+    prompts.append((question, full, budgeted))
+
+    full_tokens.append(rag.estimate_tokens(full))
+    budgeted_tokens.append(rag.estimate_tokens(budgeted))
+    answer_words = (words(answer) - words(question)) & words(full)
+    if answer_words:
+        support.append(len(answer_words & words(budgeted)) / len(answer_words))
+
+print(f"questions: {len(df)}, context budget: {args.budget} tokens")
+print(f"estimated prompt tokens: full {np.mean(full_tokens):.0f}, budgeted {np.mean(budgeted_tokens):.0f} "
+      f"({1 - np.mean(budgeted_tokens) / np.mean(full_tokens):.0%} fewer)")
+print(f"answer support kept: {np.mean(support):.1%}")
+
+if args.judge:
+    sample = [prompts[i] for i in np.random.default_rng(1).choice(len(prompts), args.judge, replace=False)]
+    for name, position in (("full", 1), ("budgeted", 2)):
+        relevance = Counter()
+        prompt_tokens = []
+        for question, *pair in sample:
+            answer, token_stats = rag.llm(pair[position - 1])
+            evaluation, _ = rag.evaluate_relevance(question, answer)
+            relevance[evaluation.get("Relevance", "UNKNOWN")] += 1
+            prompt_tokens.append(token_stats["prompt_tokens"])
+        print(f"{name}: prompt_tokens {np.mean(prompt_tokens):.0f}, relevance {dict(relevance)}")
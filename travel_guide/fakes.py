@@ -0,0 +1,180 @@
+import asyncio
+import json
+import math
+import os
+import random
+import re
+import time
+from functools import lru_cache
+from types import SimpleNamespace
+
+# Stand-ins for the external services, to benchmark and load-test without network access.
+#   "replay": Groq and the planner's HTTP APIs are served from recorded fixtures
+#   "record": the planner's HTTP APIs are called for real and their responses saved as fixtures
+#   "off":    everything is live
+FAKE_SERVICES = os.getenv("FAKE_SERVICES", "off")
+FIXTURES_PATH = os.getenv("FIXTURES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures"))
+# Multiplies every latency in services.json; 0 answers immediately
+FAKE_LATENCY_SCALE = float(os.getenv("FAKE_LATENCY_SCALE", "1"))
+# Overrides the error rate of every service when set
+FAKE_ERROR_RATE = os.getenv("FAKE_ERROR_RATE")
+
+
+class FakeServiceError(RuntimeError):
+    """An error injected by a fake service."""
+
+    def __init__(self, service, status):
+        super().__init__(f"Injected {status} error from fake {service}")
+        self.service = service
+        self.status = status
+
+
+def load_fixture(*path):
+    with open(os.path.join(FIXTURES_PATH, *path), encoding="utf-8") as f:
+        return json.load(f)
+
+
+@lru_cache(maxsize=None)
+def service_config(service):
+    """
+    Latency and errors of a service, from fixtures/services.json.
+
+    Latency is drawn from a lognormal distribution with latency_mean and latency_stddev
+    seconds, which has the long tail real APIs have. A fraction error_rate of the calls
+    fail with error_status. For Groq, the latency is the time to the first token, and the
+    answer is then generated at tokens_per_second (0 for all at once).
+    """
+    config = {"latency_mean": 0.0, "latency_stddev": 0.0, "error_rate": 0.0, "error_status": 503,
+              "tokens_per_second": 0}
+    config.update(load_fixture("services.json").get(service, {}))
+    if FAKE_ERROR_RATE is not None:
+        config["error_rate"] = float(FAKE_ERROR_RATE)
+    return config
+
+
+def sample_latency(config):
+    mean = config["latency_mean"] * FAKE_LATENCY_SCALE
+    if mean <= 0:
+        return 0.0
+    stddev = config["latency_stddev"] * FAKE_LATENCY_SCALE
+    sigma2 = math.log(1 + (stddev / mean) ** 2)
+    return random.lognormvariate(math.log(mean) - sigma2 / 2, math.sqrt(sigma2))
+
+
+def sample_error(config):
+    """Returns the status of an injected error, or None."""
+    if random.random() < config["error_rate"]:
+        return config["error_status"]
+    return None
+
+
+def count_tokens(text):
+    # Close enough to the real tokenizers for load tests: about four characters a token
+    return max(1, len(text) // 4)
+
+
+class FakeCompletions:
+    """
+    Answers chat.completions.create() like the Groq client does, from fixtures/groq.json.
+
+    Each fixture has a "match" substring; the first one found in the prompt is used. A
+    fixture with "item" answers with a JSON list of that item, one for every match of
+    "count_pattern" in the prompt (used for the batched relevance judge).
+    """
+
+    def __init__(self):
+        self.config = service_config("groq")
+        self.fixtures = load_fixture("groq.json")
+
+    def completion(self, messages):
+        prompt = "\n".join(message["content"] for message in messages)
+        fixture = next(fixture for fixture in self.fixtures if fixture["match"] in prompt)
+        if "item" in fixture:
+            count = len(re.findall(fixture["count_pattern"], prompt, flags=re.MULTILINE))
+            content = json.dumps([fixture["item"]] * count, ensure_ascii=False)
+        else:
+            content = fixture["content"]
+
+        prompt_tokens = count_tokens(prompt)
+        completion_tokens = count_tokens(content)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(role="assistant", content=content))],
+            usage=SimpleNamespace(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                total_tokens=prompt_tokens + completion_tokens,
+            ),
+        )
+
+    def token_delay(self):
+        tokens_per_second = self.config["tokens_per_second"]
+        return FAKE_LATENCY_SCALE / tokens_per_second if tokens_per_second > 0 else 0.0
+
+    def chunks(self, completion):
+        # Streamed like Groq does: one piece of content per chunk, and the usage on the last one
+        content = completion.choices[0].message.content
+        chunks = [
+            SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content[i:i + 4]),
+                                                     finish_reason=None)], x_groq=None)
+            for i in range(0, len(content), 4)
+        ]
+        chunks.append(SimpleNamespace(
+            choices=[SimpleNamespace(delta=SimpleNamespace(content=None), finish_reason="stop")],
+            x_groq=SimpleNamespace(usage=completion.usage),
+        ))
+        return chunks
+
+    def stream(self, completion):
+        delay = self.token_delay()
+        for i, chunk in enumerate(self.chunks(completion)):
+            if i:
+                time.sleep(delay)
+            yield chunk
+
+    def create(self, model, messages, stream=False, **kwargs):
+        time.sleep(sample_latency(self.config))
+        status = sample_error(self.config)
+        if status is not None:
+            raise FakeServiceError("groq", status)
+
+        completion = self.completion(messages)
+        if stream:
+            return self.stream(completion)
+        time.sleep(self.token_delay() * completion.usage.completion_tokens)
+        return completion
+
+
+class AsyncFakeCompletions(FakeCompletions):
+
+    async def stream(self, completion):
+        delay = self.token_delay()
+        for i, chunk in enumerate(self.chunks(completion)):
+            if i:
+                await asyncio.sleep(delay)
+            yield chunk
+
+    async def create(self, model, messages, stream=False, **kwargs):
+        await asyncio.sleep(sample_latency(self.config))
+        status = sample_error(self.config)
+        if status is not None:
+            raise FakeServiceError("groq", status)
+
+        completion = self.completion(messages)
+        if stream:
+            return self.stream(completion)
+        await asyncio.sleep(self.token_delay() * completion.usage.completion_tokens)
+        return completion
+
+
+class FakeGroq:
+    """Replaces groq.Groq when FAKE_SERVICES is "replay"."""
+
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=FakeCompletions())
+
+
+class AsyncFakeGroq:
+    """Replaces groq.AsyncGroq when FAKE_SERVICES is "replay"."""
+
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=AsyncFakeCompletions())
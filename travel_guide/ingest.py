@@ -1,23 +1,89 @@
+import json
 import os
-import pandas as pd
-
-import minsearch
 
 
 DATA_PATH = os.getenv("DATA_PATH", "./data/travel_data.csv")
+# Directory of a prebuilt index (see minsearch.Index.save); unset to always build from DATA_PATH
+INDEX_PATH = os.getenv("INDEX_PATH")
+
+# Defaults of the offline scripts (benchmark_retrieval.py, tune_boost.py, check_minsearch.py),
+# which are run from anywhere in a checkout: the files in the repository's data directory
+REPO_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+SCRIPT_DATA_PATH = os.getenv("DATA_PATH", os.path.join(REPO_DATA, "travel_data.csv"))
+GROUND_TRUTH_PATH = os.path.join(REPO_DATA, "ground-truth-retrieval.csv")
+
+# Boosts written by tune_boost.py; the defaults below are used until it has been run
+BOOST_PATH = os.getenv("BOOST_PATH", "./data/boost.json")
+
+DEFAULT_BOOST = {'destination': 2.485673359952678,
+                 'user_review': 2.9196237991381584,
+                 'travel_tip': 1.9014614654735604,
+                 'best_time_to_visit': 0.2946106215502525,
+                 'local_cuisine_highlights': 1.6224280634698078,
+                 'location_coordinates': 0.7452008126129724,
+                 'popular_attractions': 2.5540130530716985,
+                 'transportation_options': 1.4757377423401572,
+                 'language_spoken': 0.05435765500930245,
+                 'activities_available': 1.210048239340701,
+                 'cultural_highlights': 2.886085497384669}
+
+
+def load_boost(boost_path=BOOST_PATH):
+    if boost_path and os.path.isfile(boost_path):
+        with open(boost_path) as f:
+            return json.load(f)['boost']
+    return dict(DEFAULT_BOOST)
+
+
+BOOST = load_boost()
+
+
+# pandas and minsearch (scikit-learn) are imported when an index is built or loaded,
+# so modules that only need the settings above import quickly
+
+def load_documents(data_path=DATA_PATH):
+    import pandas as pd
 
-def load_index(data_path=DATA_PATH):
     df = pd.read_csv(data_path)
-    df.insert(0, 'id', range(1, len(df) + 1))
-    documents = df.to_dict(orient='records')
+    # An id column keeps documents' identities when rows are inserted or removed; without
+    # one, documents are numbered by row, which the ground truth refers to
+    if 'id' not in df.columns:
+        df.insert(0, 'id', range(1, len(df) + 1))
+    return df.to_dict(orient='records')
+
+
+def fit_index(documents, boost_dict=None, **index_params):
+    import minsearch
+
     index = minsearch.Index(
     text_fields=['destination', 'user_review', 'travel_tip',
        'best_time_to_visit', 'local_cuisine_highlights',
        'location_coordinates', 'popular_attractions', 'transportation_options',
        'language_spoken', 'activities_available',
        'cultural_highlights'],
-    keyword_fields=['id']
+    keyword_fields=['id'],
+    **index_params
 )
-    index.fit(documents)
+    index.fit(documents, boost_dict=boost_dict)
+
+    return index
+
+
+def build_index(data_path=DATA_PATH, boost_dict=None):
+    return fit_index(load_documents(data_path), boost_dict=boost_dict)
+
+
+def load_index(data_path=DATA_PATH, boost_dict=None, index_path=INDEX_PATH):
+    import minsearch
+
+    # A prebuilt index is memory-mapped, so gunicorn workers share it instead of each refitting
+    if index_path and os.path.isdir(index_path):
+        return minsearch.Index.load(index_path)
+
+    return build_index(data_path, boost_dict=boost_dict)
+
 
-    return index
\ No newline at end of file
+if __name__ == "__main__":
+    index_path = INDEX_PATH or "./data/index"
+    print(f"Building index from {DATA_PATH} into {index_path}...")
+    build_index(boost_dict=BOOST).save(index_path)
@@ -0,0 +1,142 @@
+import logging
+import os
+import queue
+import random
+import threading
+from time import sleep, time
+
+import db
+from rag import evaluate_relevance_batch, calculate_openai_cost
+
+logger = logging.getLogger(__name__)
+
+# Share of answers that get a relevance judgement
+JUDGE_SAMPLE_RATE = float(os.getenv("JUDGE_SAMPLE_RATE", "1.0"))
+# Answers judged together in one LLM call, and how long to wait for a batch to fill up
+JUDGE_BATCH_SIZE = int(os.getenv("JUDGE_BATCH_SIZE", "5"))
+JUDGE_BATCH_WAIT = float(os.getenv("JUDGE_BATCH_WAIT", "2.0"))
+# Times a batch is judged again after failing, before its answers are marked UNKNOWN
+JUDGE_RETRIES = int(os.getenv("JUDGE_RETRIES", "2"))
+
+JUDGE_MODEL = "llama3-8b-8192"
+
+
+class RelevanceJudge:
+    """
+    Judges the relevance of answers on a background thread, after they were returned.
+
+    /question saves the conversation with relevance PENDING and hands it to submit().
+    The worker thread collects up to batch_size conversations, waiting at most batch_wait
+    seconds for a batch to fill up, judges them with one LLM call and writes the results,
+    the judge's token use and cost, and its latency (judge_time) back to conversations.
+    A batch that fails is queued again up to retries times; after that its answers are marked
+    UNKNOWN with the error as explanation, so none of them is left PENDING.
+    """
+
+    def __init__(self, sample_rate=JUDGE_SAMPLE_RATE, batch_size=JUDGE_BATCH_SIZE, batch_wait=JUDGE_BATCH_WAIT,
+                 retries=JUDGE_RETRIES):
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.retries = retries
+        self.queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def sample(self, answer_data):
+        # Decides whether an answer gets judged, and marks it accordingly before it is saved.
+        # Cached answers were judged when they were first given.
+        if answer_data.get("cached"):
+            return False
+        evaluate = random.random() < self.sample_rate
+        if not evaluate:
+            answer_data["relevance"] = "NOT_EVALUATED"
+            answer_data["relevance_explanation"] = "Not sampled for evaluation"
+        return evaluate
+
+    def submit(self, conversation_id, question, answer):
+        # The conversation must already be saved, since the judge updates its row
+        self._start()
+        self.queue.put((conversation_id, question, answer, 0))
+
+    def _start(self):
+        # Started on first use, so gunicorn workers each get their own thread
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="relevance-judge", daemon=True)
+                self._thread.start()
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self._judge(batch)
+            except Exception as e:
+                logger.exception("Judging the relevance of %d conversations failed", len(batch))
+                self._retry(batch, e)
+
+    def _retry(self, batch, error):
+        # Requeued after a pause, so an LLM outage does not use up the retries at once
+        sleep(self.batch_wait)
+        for conversation_id, question, answer, attempts in batch:
+            if attempts < self.retries:
+                self.queue.put((conversation_id, question, answer, attempts + 1))
+
+        failed = [conversation_id for conversation_id, _, _, attempts in batch if attempts >= self.retries]
+        if not failed:
+            return
+        try:
+            db.writer.update_relevance([
+                {
+                    "conversation_id": conversation_id,
+                    "relevance": "UNKNOWN",
+                    "relevance_explanation": f"Evaluation failed: {error!r}",
+                    "eval_prompt_tokens": 0,
+                    "eval_completion_tokens": 0,
+                    "eval_total_tokens": 0,
+                    "eval_cost": 0,
+                    "judge_time": None,
+                }
+                for conversation_id in failed
+            ])
+        except Exception:
+            logger.exception("Marking %d conversations UNKNOWN failed", len(failed))
+
+    def _judge(self, batch):
+        t0 = time()
+        relevances, tokens = evaluate_relevance_batch([(question, answer) for _, question, answer, _ in batch])
+        judge_time = time() - t0
+
+        # One call judged the whole batch, so its tokens and cost are split evenly
+        share = {key: value // len(batch) for key, value in tokens.items()}
+        eval_cost = calculate_openai_cost(JUDGE_MODEL, tokens) / len(batch)
+
+        db.writer.update_relevance([
+            {
+                "conversation_id": conversation_id,
+                "relevance": relevance.get("Relevance", "UNKNOWN"),
+                "relevance_explanation": relevance.get("Explanation", "Failed to parse evaluation"),
+                "eval_prompt_tokens": share["prompt_tokens"],
+                "eval_completion_tokens": share["completion_tokens"],
+                "eval_total_tokens": share["total_tokens"],
+                "eval_cost": eval_cost,
+                "judge_time": judge_time,
+            }
+            for (conversation_id, _, _, _), relevance in zip(batch, relevances)
+        ])
+
+
+relevance_judge = RelevanceJudge()
@@ -0,0 +1,28 @@
+import threading
+
+
+class Lazy:
+    """
+    Creates a value on first call and returns the same value afterwards.
+
+    The factory runs once even when several threads call at the same time. A value created
+    before gunicorn forks its workers (see rag.preload) is shared by them copy-on-write.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._value = None
+        self._created = False
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        if not self._created:
+            with self._lock:
+                if not self._created:
+                    self._value = self.factory()
+                    self._created = True
+        return self._value
+
+    @property
+    def created(self):
+        return self._created
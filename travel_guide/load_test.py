@@ -0,0 +1,91 @@
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import requests
+
+# Compare serving modes by pointing this at each of them with the same settings:
+#   gunicorn --bind 0.0.0.0:5000 app:app
+#   uvicorn --host 0.0.0.0 --port 5000 app_async:app
+# Without network access, start the server with FAKE_SERVICES=replay (see fakes.py).
+# --target plan runs generate_full_plan in this process instead; set FAKE_SERVICES=replay
+# here for that. The default trip matches the dates of the recorded forecast fixture.
+
+parser = argparse.ArgumentParser(description="Send concurrent questions to the /question endpoint")
+parser.add_argument("--target", choices=["question", "plan"], default="question")
+parser.add_argument("--url", default="http://localhost:5000/question")
+parser.add_argument("--stream", action="store_true",
+                    help="ask /question/stream and also report the time to the first token")
+parser.add_argument("--requests", type=int, default=100, help="total number of questions to send")
+parser.add_argument("--concurrency", type=int, default=20, help="questions in flight at once")
+parser.add_argument("--trip", default='{"origin": "Stockholm", "destination": "Rome", "date": "2026-11-02", "days": 3}',
+                    help="trip_info for --target plan, as JSON")
+args = parser.parse_args()
+
+if args.target == "question":
+    df = pd.read_csv("../data/ground-truth-retrieval.csv")
+    questions = df.sample(n=args.requests, replace=True)['question'].tolist()
+
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency))
+
+    url = args.url + "/stream" if args.stream else args.url
+    first_tokens = []
+
+    def run(question):
+        t0 = time.perf_counter()
+        if not args.stream:
+            response = session.post(url, json={"question": question})
+            return time.perf_counter() - t0, response.status_code
+
+        with session.post(url, json={"question": question}, stream=True) as response:
+            for line in response.iter_lines():
+                if line == b"event: token":
+                    first_tokens.append(time.perf_counter() - t0)
+                    break
+            # Read the rest of the stream, so the answer is complete and saved
+            for _ in response.iter_lines():
+                pass
+        return time.perf_counter() - t0, response.status_code
+
+    print(f"Sending {args.requests} questions to {url}, {args.concurrency} at a time...")
+else:
+    import json
+
+    # generate_full_plan is imported from the travel_guide package, like the planner does
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from travel_guide.planner.generator import generate_full_plan
+
+    trip_info = json.loads(args.trip)
+    questions = [trip_info] * args.requests
+
+    def run(trip_info):
+        t0 = time.perf_counter()
+        try:
+            generate_full_plan(dict(trip_info))
+            status = 200
+        except Exception:
+            status = 500
+        return time.perf_counter() - t0, status
+
+    print(f"Generating {args.requests} plans, {args.concurrency} at a time...")
+
+t0 = time.perf_counter()
+with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+    results = list(executor.map(run, questions))
+took = time.perf_counter() - t0
+
+latencies = np.array([latency for latency, _ in results])
+errors = sum(status != 200 for _, status in results)
+
+print(f"throughput: {len(results) / took:.2f} requests/s")
+print(f"latency p50: {np.percentile(latencies, 50):.2f}s, p95: {np.percentile(latencies, 95):.2f}s, max: {latencies.max():.2f}s")
+print(f"errors: {errors}")
+if args.target == "question" and args.stream and first_tokens:
+    first_tokens = np.array(first_tokens)
+    print(f"time to first token p50: {np.percentile(first_tokens, 50):.2f}s, p95: {np.percentile(first_tokens, 95):.2f}s")
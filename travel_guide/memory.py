@@ -0,0 +1,11 @@
+import os
+import resource
+
+
+def rss_mb():
+    """Resident memory of this process in MB; ru_maxrss (the peak) is used where /proc is missing."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
@@ -0,0 +1,180 @@
+import asyncio
+import functools
+import math
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+
+# Counters and histograms of the request path, served in the Prometheus text format by the
+# /metrics endpoint of app.py and app_async.py. They are kept per process: run one gunicorn
+# worker (the default) or scrape each worker, since a scrape only sees the worker it reaches.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds; from an index search to a slow LLM call
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class Counter:
+    """A count that only goes up, one per combination of label values."""
+
+    type = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}"
+
+
+class Histogram:
+    """
+    Observations counted into cumulative buckets, with their count and sum, one set per
+    combination of label values.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = format_labels(self.labelnames, key, [("le", format_value(bound))])
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {format_value(total)}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+stage_seconds = REGISTRY.register(Histogram(
+    "travel_guide_stage_seconds", "Time spent in each stage of answering a question.", ["stage"],
+))
+stage_errors = REGISTRY.register(Counter(
+    "travel_guide_stage_errors_total", "Exceptions raised by each stage.", ["stage", "error"],
+))
+llm_tokens = REGISTRY.register(Counter(
+    "travel_guide_llm_tokens_total", "Tokens used by LLM calls, answers and judgements alike.", ["model", "kind"],
+))
+cache_lookups = REGISTRY.register(Counter(
+    "travel_guide_answer_cache_lookups_total", "Answer cache lookups by layer and result.", ["layer", "result"],
+))
+
+
+def observe_stage(stage, seconds):
+    stage_seconds.observe(seconds, stage=stage)
+
+
+def record_error(stage, error):
+    stage_errors.inc(stage=stage, error=type(error).__name__)
+
+
+@contextmanager
+def timer(stage):
+    """Times the block as the given stage; an exception is counted as an error of the stage and re-raised."""
+    t0 = perf_counter()
+    try:
+        yield
+    except Exception as e:
+        record_error(stage, e)
+        raise
+    finally:
+        observe_stage(stage, perf_counter() - t0)
+
+
+def timed(stage):
+    """Decorates a function or coroutine function to run under timer(stage)."""
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with timer(stage):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+def record_tokens(model, token_stats):
+    llm_tokens.inc(token_stats["prompt_tokens"], model=model, kind="prompt")
+    llm_tokens.inc(token_stats["completion_tokens"], model=model, kind="completion")
+
+
+def render():
+    return REGISTRY.render()
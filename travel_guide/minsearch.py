@@ -1,96 +1,1232 @@
-import pandas as pd
+import copy
+import json
+import os
+import shutil
+import logging
+import threading
+import time
+from collections import Counter
 
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.feature_extraction.text import CountVectorizer
 
 import numpy as np
+import scipy.sparse as sp
+
+
+logger = logging.getLogger(__name__)
+
+# TfidfVectorizer parameters the index applies itself; the rest go to CountVectorizer
+TFIDF_PARAMS = ('norm', 'use_idf', 'smooth_idf', 'sublinear_tf')
 
 
 class Index:
     """
     A simple search index using TF-IDF and cosine similarity for text fields and exact matching for keyword fields.
 
+    All text fields are scored together: the per-field TF-IDF matrices are L2-normalized,
+    multiplied by their boost and stacked side by side into one CSR matrix, so a query needs
+    a single tokenization pass and a single sparse mat-vec.
+
+    Documents can be added, updated and deleted without refitting. New terms get new columns,
+    deleted rows are zeroed out, and the IDF weights are recomputed by refresh(), which
+    search() calls on its own once refresh_ratio of the corpus has changed since the last one.
+
+    With inverted_index=True the index also keeps a posting list and an upper-bound weight
+    per fused column, and search() uses MaxScore-style pruning: it only scores documents
+    that share terms with the query and stops once the remaining terms cannot lift any
+    unseen document into the top results. Results are the same as a full scan.
+
     Attributes:
         text_fields (list): List of text field names to index.
         keyword_fields (list): List of keyword field names to index.
-        vectorizers (dict): Dictionary of TfidfVectorizer instances for each text field.
-        keyword_df (pd.DataFrame): DataFrame containing keyword field data.
-        text_matrices (dict): Dictionary of TF-IDF matrices for each text field.
-        docs (list): List of documents indexed.
+        vectorizers (dict): Dictionary of CountVectorizer instances that learn each text field's initial vocabulary.
+        keyword_postings (dict): For each keyword field, maps every value to the sorted row ids holding it.
+        docs (list): List of documents indexed, one per row. Deleted documents keep their row.
+        live (np.ndarray): Whether each row still holds an indexed document.
+        id_field (str): Document field that add(), update() and delete() identify documents by.
+        id_rows (dict): Maps the id of every live document to its row.
+        fit_boosts (np.ndarray): Boost of each text field folded into the fused matrix.
+        vocabularies (dict): For each text field, maps a token to its fused column.
+        counts (scipy.sparse.csr_matrix): Raw term counts of shape (n_docs, n_columns).
+        df (np.ndarray): Number of live documents containing each fused column's term.
+        matrix (scipy.sparse.csr_matrix): Fused, boost-weighted matrix of shape (n_docs, n_columns).
+        term_columns (dict): Maps a token to the fused columns (one per field vocabulary) it occupies.
+        idf (np.ndarray): IDF weight of each fused column.
+        column_field (np.ndarray): Position in text_fields of the field each fused column belongs to.
+        refresh_ratio (float): Share of the corpus that may change before search() refreshes the IDF weights.
+        inverted_index (bool): Whether search() prunes candidates through the posting lists.
+        postings (scipy.sparse.csc_matrix): The fused matrix in column order, one posting list per column.
+        upper_bounds (np.ndarray): Largest weight in each posting list.
     """
 
-    def __init__(self, text_fields, keyword_fields, vectorizer_params={}):
+    def __init__(self, text_fields, keyword_fields, vectorizer_params={}, inverted_index=False,
+                 id_field='id', refresh_ratio=0.1):
         """
         Initializes the Index with specified text and keyword fields.
 
         Args:
             text_fields (list): List of text field names to index.
             keyword_fields (list): List of keyword field names to index.
-            vectorizer_params (dict): Optional parameters to pass to TfidfVectorizer.
+            vectorizer_params (dict): Optional parameters, as accepted by TfidfVectorizer.
+            inverted_index (bool): Build posting lists at fit time and prune candidates in search().
+            id_field (str): Document field that identifies documents for update() and delete().
+            refresh_ratio (float): Share of the corpus that may change before search() refreshes
+                the IDF weights. None leaves refreshing to explicit refresh() calls.
         """
         self.text_fields = text_fields
         self.keyword_fields = keyword_fields
+        self.vectorizer_params = vectorizer_params
 
-        self.vectorizers = {field: TfidfVectorizer(**vectorizer_params) for field in text_fields}
-        self.keyword_df = None
-        self.text_matrices = {}
+        count_params = {key: value for key, value in vectorizer_params.items() if key not in TFIDF_PARAMS}
+        self.vectorizers = {field: CountVectorizer(**count_params) for field in text_fields}
+        # All fields share vectorizer_params, so one analyzer tokenizes for every field
+        self.analyzer = CountVectorizer(**count_params).build_analyzer()
+        self.keyword_postings = {}
         self.docs = []
+        self.live = np.zeros(0, dtype=bool)
+        self.id_field = id_field
+        self.id_rows = {}
+
+        self.fit_boosts = np.ones(len(text_fields))
+        self.vocabularies = {field: {} for field in text_fields}
+        self.counts = None
+        self.df = np.zeros(0)
+        self.matrix = None
+        self.term_columns = {}
+        self.idf = np.zeros(0)
+        self.column_field = np.zeros(0, dtype=np.intp)
+
+        self.inverted_index = inverted_index
+        self.postings = None
+        self.upper_bounds = np.zeros(0)
 
-    def fit(self, docs):
+        self.refresh_ratio = refresh_ratio
+        self._changes = 0
+        self._postings_stale = False
+
+    def fit(self, docs, boost_dict=None):
         """
         Fits the index with the provided documents.
 
         Args:
             docs (list of dict): List of documents to index. Each document is a dictionary.
+            boost_dict (dict): Optional boost scores to fold into the fused matrix. Searching
+                with the same boosts then costs nothing extra; other boosts are applied by
+                rescaling the query. Fitted boosts must be positive.
         """
-        self.docs = docs
-        keyword_data = {field: [] for field in self.keyword_fields}
+        boost_dict = boost_dict or {}
+        fit_boosts = self._boost_vector(boost_dict)
+        if np.any(fit_boosts <= 0):
+            raise ValueError("Boosts folded in at fit time must be positive")
 
-        for field in self.text_fields:
-            texts = [doc.get(field, '') for doc in docs]
-            self.text_matrices[field] = self.vectorizers[field].fit_transform(texts)
+        self.docs = list(docs)
+        self.live = np.ones(len(self.docs), dtype=bool)
+        self.fit_boosts = fit_boosts
 
-        for doc in docs:
-            for field in self.keyword_fields:
-                keyword_data[field].append(doc.get(field, ''))
+        blocks = []
+        column_field = []
+        offset = 0
+        for i, field in enumerate(self.text_fields):
+            texts = [doc.get(field, '') for doc in self.docs]
+            vectorizer = self.vectorizers[field]
+            blocks.append(vectorizer.fit_transform(texts))
+            self.vocabularies[field] = {term: offset + int(column) for term, column in vectorizer.vocabulary_.items()}
+            column_field.append(np.full(len(vectorizer.vocabulary_), i, dtype=np.intp))
+            offset += len(vectorizer.vocabulary_)
 
-        self.keyword_df = pd.DataFrame(keyword_data)
+        self.counts = sp.hstack(blocks, format='csr', dtype=np.float64)
+        self.column_field = np.concatenate(column_field)
+
+        self._build_term_columns()
+        self._build_keyword_postings()
+        self.refresh()
 
         return self
 
+    def refresh(self):
+        """
+        Recomputes the IDF weights from the live documents and reweights every row.
+
+        This is the only step whose cost grows with the whole corpus; add(), update() and
+        delete() leave it to the next refresh.
+        """
+        self._make_writable()
+        self.counts.eliminate_zeros()
+
+        df = np.bincount(self.counts.indices, minlength=self.counts.shape[1]).astype(np.float64)
+        idf = self._idf(df)
+        self.df, self.idf, self.matrix = df, idf, self._weigh(self.counts, idf)
+
+        if self.inverted_index:
+            self._build_postings()
+        self._changes = 0
+
+    def add(self, docs):
+        """
+        Adds documents to the index without refitting it.
+
+        Terms that are new to a field get new columns. The new rows are weighted with the
+        current IDF weights, which are only updated for every row by refresh(). Each call
+        copies the fused matrix once, so add documents in batches where possible.
+
+        Args:
+            docs (list of dict): Documents to add. Each document is a dictionary.
+        """
+        if not docs:
+            return
+        for doc in docs:
+            if doc.get(self.id_field) in self.id_rows:
+                raise ValueError(f"A document with {self.id_field}={doc[self.id_field]!r} is already indexed")
+
+        self._make_writable()
+        start = len(self.docs)
+        n_columns = self.counts.shape[1]
+
+        counts = self._count(docs)
+        self.counts = sp.vstack([self._widen(self.counts), counts], format='csr')
+        self.df = np.concatenate([self.df, np.zeros(counts.shape[1] - n_columns)])
+        self.df += np.bincount(counts.indices, minlength=counts.shape[1])
+        self.docs.extend(docs)
+        self.live = np.concatenate([self.live, np.ones(len(docs), dtype=bool)])
+
+        # Existing columns keep their IDF until the next refresh
+        self.idf = np.concatenate([self.idf, self._idf(self.df[n_columns:])])
+        self.matrix = sp.vstack([self._widen(self.matrix), self._weigh(counts, self.idf)], format='csr')
+
+        for row in range(start, len(self.docs)):
+            self._index_keywords(row)
+
+        self._postings_stale = self.inverted_index
+        self._changes += len(docs)
+
+    def update(self, doc_id, doc):
+        """
+        Replaces the document with the given id.
+
+        Args:
+            doc_id: Value of id_field of the document to replace.
+            doc (dict): The new document.
+        """
+        self.delete(doc_id)
+        self.add([doc])
+
+    def delete(self, doc_id):
+        """
+        Removes the document with the given id from the index.
+
+        Its row is zeroed out and kept as a tombstone until the next refresh() compacts it.
+
+        Args:
+            doc_id: Value of id_field of the document to remove.
+        """
+        if doc_id not in self.id_rows:
+            raise KeyError(f"No document with {self.id_field}={doc_id!r}")
+
+        self._make_writable()
+        row = self.id_rows[doc_id]
+        self._unindex_keywords(row)
+        self.live[row] = False
+
+        start, end = self.counts.indptr[row], self.counts.indptr[row + 1]
+        columns = self.counts.indices[start:end]
+        self.df[columns] -= self.counts.data[start:end] > 0
+        self.counts.data[start:end] = 0
+        self.matrix.data[self.matrix.indptr[row]:self.matrix.indptr[row + 1]] = 0
+
+        if self.inverted_index and not self._postings_stale:
+            for column in columns:
+                column_start, column_end = self.postings.indptr[column], self.postings.indptr[column + 1]
+                position = column_start + np.searchsorted(self.postings.indices[column_start:column_end], row)
+                self.postings.data[position] = 0
+
+        self._changes += 1
+
+    def save(self, path):
+        """
+        Saves the fitted index to a directory that load() can memory-map.
+
+        The fused matrix, raw counts, IDF weights and column metadata are written as .npy
+        files; the vocabularies, settings and documents as JSON. They go to a new directory
+        next to path, and path is a symlink that is then switched to it in one rename, so a
+        concurrent load() finds either the previous index or this one, never none or half.
+
+        Args:
+            path (str): Symlink to write the index to. Replaced if it already exists.
+        """
+        if self._postings_stale:
+            self._build_postings()
+
+        path = os.path.abspath(path)
+        tmp_path = f"{path}.{time.time_ns()}-{os.getpid()}"
+        os.makedirs(tmp_path)
+
+        self.matrix.sort_indices()
+        arrays = {
+            'matrix_data': self.matrix.data,
+            'matrix_indices': self.matrix.indices,
+            'matrix_indptr': self.matrix.indptr,
+            'counts_data': self.counts.data,
+            'counts_indices': self.counts.indices,
+            'counts_indptr': self.counts.indptr,
+            'df': self.df,
+            'live': self.live,
+            'idf': self.idf,
+            'column_field': self.column_field,
+            'fit_boosts': self.fit_boosts,
+        }
+        if self.inverted_index:
+            arrays.update({
+                'postings_data': self.postings.data,
+                'postings_indices': self.postings.indices,
+                'postings_indptr': self.postings.indptr,
+                'upper_bounds': self.upper_bounds,
+            })
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, f"{name}.npy"), array)
+
+        meta = {
+            'text_fields': self.text_fields,
+            'keyword_fields': self.keyword_fields,
+            'vectorizer_params': self.vectorizer_params,
+            'inverted_index': self.inverted_index,
+            'id_field': self.id_field,
+            'refresh_ratio': self.refresh_ratio,
+            'changes': self._changes,
+            'shape': list(self.matrix.shape),
+        }
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        with open(os.path.join(tmp_path, 'vocabularies.json'), 'w') as f:
+            json.dump(self.vocabularies, f)
+        with open(os.path.join(tmp_path, 'docs.json'), 'w') as f:
+            json.dump(self.docs, f)
+
+        previous = os.path.realpath(path) if os.path.islink(path) else None
+        if os.path.isdir(path) and previous is None:
+            # A directory saved before path was a symlink cannot be swapped in one rename,
+            # so it is moved aside once, leaving path missing for that moment
+            previous = f"{tmp_path}.old"
+            os.rename(path, previous)
+
+        # The link target is relative, so the directory holding the index can be moved or mounted
+        link_path = f"{tmp_path}.link"
+        os.symlink(os.path.basename(tmp_path), link_path)
+        os.replace(link_path, path)
+        if previous is not None:
+            shutil.rmtree(previous, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """
+        Loads an index written by save() without refitting any vectorizer.
+
+        With the default mmap_mode the numeric arrays stay backed by the files, so every
+        process that loads the same directory shares one copy of them in the page cache.
+        The loaded index searches exactly like the saved one, but its vectorizers are unfitted.
+        The first add(), update(), delete() or refresh() copies the arrays into memory.
+
+        Args:
+            path (str): Directory written by save().
+            mmap_mode (str): Passed to np.load. Use None to read the arrays into memory.
+
+        Returns:
+            Index: The loaded index.
+        """
+        while True:
+            # Every file is read from the directory path links to now, even if save() switches it meanwhile
+            version = os.path.realpath(path)
+            try:
+                return cls._load(version, mmap_mode)
+            except FileNotFoundError:
+                # save() removed this version while it was read: read the one that replaced it
+                if os.path.realpath(path) == version:
+                    raise
+
+    @classmethod
+    def _load(cls, path, mmap_mode):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+
+        index = cls(
+            meta['text_fields'],
+            meta['keyword_fields'],
+            meta['vectorizer_params'],
+            meta['inverted_index'],
+            meta['id_field'],
+            meta['refresh_ratio'],
+        )
+        index._changes = meta['changes']
+
+        def load_array(name):
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+
+        index.matrix = sp.csr_matrix(
+            (load_array('matrix_data'), load_array('matrix_indices'), load_array('matrix_indptr')),
+            shape=tuple(meta['shape']),
+            copy=False,
+        )
+        index.matrix.has_sorted_indices = True
+        index.counts = sp.csr_matrix(
+            (load_array('counts_data'), load_array('counts_indices'), load_array('counts_indptr')),
+            shape=tuple(meta['shape']),
+            copy=False,
+        )
+        index.counts.has_sorted_indices = True
+        index.df = load_array('df')
+        index.live = load_array('live')
+        index.idf = load_array('idf')
+        index.column_field = load_array('column_field')
+        index.fit_boosts = np.array(load_array('fit_boosts'))
+        if index.inverted_index:
+            index.postings = sp.csc_matrix(
+                (load_array('postings_data'), load_array('postings_indices'), load_array('postings_indptr')),
+                shape=tuple(meta['shape']),
+                copy=False,
+            )
+            index.postings.has_sorted_indices = True
+            index.upper_bounds = load_array('upper_bounds')
+
+        with open(os.path.join(path, 'vocabularies.json')) as f:
+            index.vocabularies = json.load(f)
+        with open(os.path.join(path, 'docs.json')) as f:
+            index.docs = json.load(f)
+
+        index._build_term_columns()
+        index._build_keyword_postings()
+
+        return index
+
+    def _make_writable(self):
+        """
+        Copies arrays memory-mapped by load() into memory before they are modified.
+        """
+        if self.matrix is None or self.matrix.data.flags.writeable:
+            return
+
+        self.matrix = self.matrix.copy()
+        self.counts = self.counts.copy()
+        self.df = np.array(self.df)
+        self.live = np.array(self.live)
+        self.idf = np.array(self.idf)
+        self.column_field = np.array(self.column_field)
+        if self.postings is not None:
+            self.postings = self.postings.copy()
+            self.upper_bounds = np.array(self.upper_bounds)
+
+    def _build_keyword_postings(self):
+        """
+        Builds, for every keyword field, the row ids holding each of its values, and the
+        row of every live document id.
+        """
+        self.keyword_postings = {}
+        for field in self.keyword_fields:
+            rows = {}
+            for row in np.flatnonzero(self.live):
+                rows.setdefault(self.docs[row].get(field, ''), []).append(row)
+            self.keyword_postings[field] = {value: np.array(ids, dtype=np.intp) for value, ids in rows.items()}
+
+        self.id_rows = {
+            self.docs[row][self.id_field]: int(row)
+            for row in np.flatnonzero(self.live) if self.id_field in self.docs[row]
+        }
+
+    def _index_keywords(self, row):
+        doc = self.docs[row]
+        for field in self.keyword_fields:
+            postings = self.keyword_postings[field]
+            value = doc.get(field, '')
+            postings[value] = np.append(postings.get(value, np.zeros(0, dtype=np.intp)), row)
+        if self.id_field in doc:
+            self.id_rows[doc[self.id_field]] = row
+
+    def _unindex_keywords(self, row):
+        doc = self.docs[row]
+        for field in self.keyword_fields:
+            postings = self.keyword_postings[field]
+            value = doc.get(field, '')
+            postings[value] = postings[value][postings[value] != row]
+            if not len(postings[value]):
+                del postings[value]
+        self.id_rows.pop(doc.get(self.id_field), None)
+
+    def _build_term_columns(self):
+        term_columns = {}
+        for vocabulary in self.vocabularies.values():
+            for term, column in vocabulary.items():
+                term_columns.setdefault(term, []).append(column)
+        self.term_columns = {term: np.array(columns, dtype=np.intp) for term, columns in term_columns.items()}
+
+    def _count(self, docs, grow=True):
+        """
+        Counts the terms of new documents, giving terms new to a field their own column.
+
+        Args:
+            docs (list of dict): Documents to count.
+            grow (bool): Add columns for new terms. Otherwise terms the vocabularies do not
+                hold are left out.
+
+        Returns:
+            scipy.sparse.csr_matrix: Raw term counts of shape (len(docs), n_columns).
+        """
+        binary = self.vectorizer_params.get('binary', False)
+        n_columns = len(self.column_field)
+        new_column_field = []
+
+        rows = []
+        columns = []
+        counts = []
+        for row, doc in enumerate(docs):
+            for i, field in enumerate(self.text_fields):
+                vocabulary = self.vocabularies[field]
+                for term, count in Counter(self.analyzer(doc.get(field, ''))).items():
+                    column = vocabulary.get(term)
+                    if column is None and not grow:
+                        continue
+                    if column is None:
+                        column = vocabulary[term] = n_columns + len(new_column_field)
+                        new_column_field.append(i)
+                        self.term_columns[term] = np.append(self.term_columns.get(term, np.zeros(0, dtype=np.intp)), column)
+                    rows.append(row)
+                    columns.append(column)
+                    counts.append(1 if binary else count)
+
+        if new_column_field:
+            self.column_field = np.concatenate([self.column_field, np.array(new_column_field, dtype=np.intp)])
+
+        counts = sp.csr_matrix(
+            (np.array(counts, dtype=np.float64), (rows, columns)),
+            shape=(len(docs), len(self.column_field)),
+        )
+        counts.sort_indices()
+        return counts
+
+    def _has_new_terms(self, docs):
+        """
+        Tells whether documents hold terms a field's vocabulary does not, which _segment()
+        leaves out until the next merge.
+        """
+        return any(
+            term not in self.vocabularies[field]
+            for doc in docs
+            for field in self.text_fields
+            for term in self.analyzer(doc.get(field, ''))
+        )
+
+    def _segment(self, docs):
+        """
+        Indexes documents in a small index that shares this one's columns and IDF weights.
+
+        The segment's rows score against queries vectorized by this index, so its results
+        can be merged with this index's by score. Terms the vocabularies do not hold are left
+        out of the segment. The shared vocabularies must not grow while the segment is used,
+        so only delete() may be called on it.
+
+        Args:
+            docs (list of dict): Documents to index.
+
+        Returns:
+            Index: The segment.
+        """
+        segment = copy.copy(self)
+        segment.docs = list(docs)
+        segment.live = np.ones(len(segment.docs), dtype=bool)
+        segment.counts = self._count(segment.docs, grow=False)
+        segment.df = np.bincount(segment.counts.indices, minlength=segment.counts.shape[1]).astype(np.float64)
+        segment.matrix = self._weigh(segment.counts, self.idf)
+
+        segment.inverted_index = False
+        segment.postings = None
+        segment.upper_bounds = np.zeros(0)
+        segment.refresh_ratio = None
+        segment._changes = 0
+        segment._postings_stale = False
+        segment._build_keyword_postings()
+
+        return segment
+
+    def _compact(self):
+        """
+        Drops the rows of deleted documents and refreshes the IDF weights.
+        """
+        rows = np.flatnonzero(self.live)
+        self._make_writable()
+        self.counts = self.counts[rows]
+        self.docs = [self.docs[row] for row in rows]
+        self.live = np.ones(len(rows), dtype=bool)
+        self._build_keyword_postings()
+        self.refresh()
+
+    def _widen(self, matrix):
+        # New columns are empty in existing rows, so only the shape changes
+        return sp.csr_matrix((matrix.data, matrix.indices, matrix.indptr), shape=(matrix.shape[0], len(self.column_field)))
+
+    def _idf(self, df):
+        """
+        Computes IDF weights the way TfidfVectorizer does, over the live documents.
+        """
+        if not self.vectorizer_params.get('use_idf', True):
+            return np.ones(len(df))
+
+        smooth = int(self.vectorizer_params.get('smooth_idf', True))
+        n_docs = int(self.live.sum()) + smooth
+        return np.log(n_docs / np.maximum(df + smooth, 1)) + 1
+
+    def _weigh(self, counts, idf):
+        """
+        Turns raw counts into fused matrix rows.
+
+        Each field's slice of a row is weighted by TF-IDF and L2-normalized on its own, as
+        cosine_similarity would do per field, then multiplied by the field's fitted boost.
+        """
+        tf = counts.data
+        if self.vectorizer_params.get('sublinear_tf', False):
+            tf = 1 + np.log(tf)
+
+        values = tf * idf[counts.indices]
+        fields = self.column_field[counts.indices]
+        rows = np.repeat(np.arange(counts.shape[0]), np.diff(counts.indptr))
+        slots = rows * len(self.text_fields) + fields
+        norms = np.sqrt(np.bincount(slots, weights=values ** 2, minlength=counts.shape[0] * len(self.text_fields)))
+        norms[norms == 0] = 1
+        values = values / norms[slots] * self.fit_boosts[fields]
+
+        return sp.csr_matrix((values, counts.indices.copy(), counts.indptr.copy()), shape=counts.shape)
+
+    def _build_postings(self):
+        """
+        Builds the posting list of every fused column and the largest weight in each.
+        """
+        postings = self.matrix.tocsc()
+        postings.sort_indices()
+
+        upper_bounds = np.zeros(postings.shape[1])
+        nonempty = np.diff(postings.indptr) > 0
+        if nonempty.any():
+            # Empty columns have no length, so consecutive starts delimit the non-empty ones
+            upper_bounds[nonempty] = np.maximum.reduceat(postings.data, postings.indptr[:-1][nonempty])
+
+        self.postings = postings
+        self.upper_bounds = upper_bounds
+        self._postings_stale = False
+
+    def _refresh_if_stale(self):
+        if self._changes and self.refresh_ratio is not None and self._changes > self.refresh_ratio * max(self.live.sum(), 1):
+            self.refresh()
+        elif self._postings_stale:
+            self._build_postings()
+
+    def _boost_vector(self, boost_dict):
+        return np.array([boost_dict.get(field, 1) for field in self.text_fields], dtype=np.float64)
+
+    def _query_matrix(self, queries, boost_dict):
+        """
+        Vectorizes queries against every field vocabulary at once.
+
+        Each field's slice of a query row is L2-normalized on its own, so the product with the
+        fused matrix equals the boosted sum of the per-field cosine similarities.
+
+        Args:
+            queries (list of str): The search query strings.
+            boost_dict (dict): Dictionary of boost scores for text fields.
+
+        Returns:
+            scipy.sparse.csr_matrix: Query matrix of shape (len(queries), n_columns).
+        """
+        n_fields = len(self.text_fields)
+        n_columns = self.matrix.shape[1]
+
+        rows = []
+        columns = []
+        tf = []
+        for row, query in enumerate(queries):
+            for term, count in Counter(self.analyzer(query)).items():
+                term_columns = self.term_columns.get(term)
+                if term_columns is not None:
+                    rows.append(np.full(len(term_columns), row, dtype=np.intp))
+                    columns.append(term_columns)
+                    tf.append(np.full(len(term_columns), count, dtype=np.float64))
+
+        if not columns:
+            return sp.csr_matrix((len(queries), n_columns))
+
+        rows = np.concatenate(rows)
+        columns = np.concatenate(columns)
+        tf = np.concatenate(tf)
+
+        # Terms only deleted documents had are unknown to the corpus, as after a refit
+        known = self.df[columns] > 0
+        rows, columns, tf = rows[known], columns[known], tf[known]
+        if self.vectorizer_params.get('binary', False):
+            tf = np.ones_like(tf)
+        elif self.vectorizer_params.get('sublinear_tf', False):
+            tf = 1 + np.log(tf)
+
+        values = tf * self.idf[columns]
+        # One norm per (query, field) pair
+        slots = rows * n_fields + self.column_field[columns]
+        norms = np.sqrt(np.bincount(slots, weights=values ** 2, minlength=len(queries) * n_fields))
+        norms[norms == 0] = 1
+
+        scale = self._boost_vector(boost_dict) / self.fit_boosts
+        values = values * scale[self.column_field[columns]] / norms[slots]
+
+        return sp.csr_matrix((values, (rows, columns)), shape=(len(queries), n_columns))
+
+    def _filter_rows(self, filter_dict):
+        """
+        Resolves keyword filters to the rows that pass all of them.
+
+        Filters on different fields are combined with AND. A list, tuple or set value
+        matches any of its items. The cost depends on the number of matches, not on the
+        size of the index.
+
+        Args:
+            filter_dict (dict): Dictionary of keyword fields to filter by.
+
+        Returns:
+            np.ndarray: Sorted row ids, or None if no filter applies to a keyword field.
+        """
+        rows = None
+        for field, value in filter_dict.items():
+            if field not in self.keyword_fields:
+                continue
+
+            postings = self.keyword_postings[field]
+            if isinstance(value, (list, tuple, set, frozenset)):
+                matches = [postings[item] for item in value if item in postings]
+                field_rows = np.unique(np.concatenate(matches)) if matches else np.zeros(0, dtype=np.intp)
+            else:
+                field_rows = postings.get(value, np.zeros(0, dtype=np.intp))
+
+            rows = field_rows if rows is None else np.intersect1d(rows, field_rows, assume_unique=True)
+
+        return rows
+
+    def _pruned_scores(self, query_vec, num_results):
+        """
+        Scores only the documents that can reach the top num_results, MaxScore style.
+
+        The posting lists of the strongest query terms are scored first to get a threshold:
+        the num_results-th best score so far. Terms whose summed upper bounds stay below it
+        are non-essential, since a document found only in their lists cannot reach the top
+        results. Candidates therefore come from the essential lists alone, and each one is
+        then scored exactly against the whole query.
+
+        When exact scoring of the candidates would read more entries than the query's posting
+        lists hold, the lists are summed term-at-a-time instead, which is exact as well.
+
+        Args:
+            query_vec (scipy.sparse.csr_matrix): Query row from _query_matrix() with non-negative weights.
+            num_results (int): The number of top results wanted.
+
+        Returns:
+            tuple: Row ids of the scored documents and their exact scores.
+        """
+        bounds = query_vec.data * self.upper_bounds[query_vec.indices]
+        strongest_first = np.argsort(-bounds)
+
+        postings_size = np.diff(self.postings.indptr)[query_vec.indices].sum()
+        row_size = self.matrix.nnz / max(self.matrix.shape[0], 1)
+
+        def walk(terms):
+            # Sums the given terms' posting lists; only their documents are touched
+            partial = sp.csr_matrix(
+                (query_vec.data[terms], query_vec.indices[terms], [0, len(terms)]),
+                shape=query_vec.shape,
+            )
+            scores = partial @ self.postings.T
+            return scores.indices, scores.data
+
+        def exact_scores(doc_ids):
+            return (self.matrix[doc_ids] @ query_vec.T).toarray().ravel()
+
+        def cheaper_to_walk_all(doc_ids):
+            return len(doc_ids) * row_size >= postings_size
+
+        # Strongest terms first, until there are enough candidates for a threshold
+        n_first = 0
+        doc_ids = np.zeros(0, dtype=np.intp)
+        while n_first < len(bounds) and len(doc_ids) < num_results:
+            n_first += 1
+            doc_ids, _ = walk(strongest_first[:n_first])
+        if cheaper_to_walk_all(doc_ids):
+            return walk(strongest_first)
+        scores = exact_scores(doc_ids)
+        if len(doc_ids) < num_results:
+            # Every term was walked, so these are all the matching documents
+            return doc_ids, scores
+
+        threshold = np.partition(scores, -num_results)[-num_results]
+
+        # Weakest terms are non-essential while their bounds add up to less than the threshold
+        n_non_essential = np.searchsorted(np.cumsum(bounds[strongest_first[::-1]]), threshold, side='left')
+        doc_ids, _ = walk(strongest_first[:len(bounds) - n_non_essential])
+        if cheaper_to_walk_all(doc_ids):
+            return walk(strongest_first)
+
+        return doc_ids, exact_scores(doc_ids)
+
+    def _top_rows(self, scores, num_results, doc_ids=None, kth_score=None):
+        """
+        Ranks the rows with the highest positive scores, best first.
+
+        Args:
+            scores (np.ndarray): Scores to rank.
+            num_results (int): The number of top results to return.
+            doc_ids (np.ndarray): Row ids the scores belong to. Defaults to every row in order.
+            kth_score (float): The num_results-th highest score, if already known.
+
+        Returns:
+            tuple: Row ids of the top documents and their scores.
+        """
+        num_results = min(num_results, len(scores))
+        if num_results <= 0:
+            return np.zeros(0, dtype=np.intp), np.zeros(0)
+
+        if doc_ids is None:
+            doc_ids = np.arange(len(scores))
+        if kth_score is None:
+            kth_score = np.partition(scores, -num_results)[-num_results]
+
+        # Keep everything tied with the num_results-th score, then let ties go to the earlier
+        # document, so pruned, full and batched scans return the same documents in the same order
+        top_indices = np.flatnonzero(scores >= kth_score)
+        top_indices = top_indices[np.lexsort((doc_ids[top_indices], -scores[top_indices]))][:num_results]
+
+        # Filter out zero-score results
+        top_indices = top_indices[scores[top_indices] > 0]
+        return doc_ids[top_indices], scores[top_indices]
+
+    def _score(self, query_vec, filter_dict, num_results):
+        """
+        Finds the top rows for one vectorized query.
+
+        Args:
+            query_vec (scipy.sparse.csr_matrix): Query row from _query_matrix().
+            filter_dict (dict): Dictionary of keyword fields to filter by, as in search().
+            num_results (int): The number of top results to return.
+
+        Returns:
+            tuple: Row ids of the top documents and their scores, best first.
+        """
+        # Every path below assumes there is a num_results-th score to find
+        if num_results <= 0:
+            return np.zeros(0, dtype=np.intp), np.zeros(0)
+
+        # Apply keyword filters: only the rows that pass them are scored
+        rows = self._filter_rows(filter_dict)
+        if rows is not None:
+            scores = (self.matrix[rows] @ query_vec.T).toarray().ravel()
+            return self._top_rows(scores, num_results, rows)
+
+        # Upper bounds only hold when no boost turns a contribution negative
+        if self.inverted_index and not np.any(query_vec.data < 0):
+            doc_ids, scores = self._pruned_scores(query_vec, num_results)
+            return self._top_rows(scores, num_results, doc_ids)
+
+        # One sparse mat-vec scores every field with its boost applied
+        scores = (self.matrix @ query_vec.T).toarray().ravel()
+
+        return self._top_rows(scores, num_results)
+
     def search(self, query, filter_dict={}, boost_dict={}, num_results=10):
         """
         Searches the index with the given query, filters, and boost parameters.
 
         Args:
             query (str): The search query string.
-            filter_dict (dict): Dictionary of keyword fields to filter by. Keys are field names and values are the values to filter by.
+            filter_dict (dict): Dictionary of keyword fields to filter by. Keys are field names and values are the values to filter by;
+                a list, tuple or set of values matches any of them. All filters must match.
             boost_dict (dict): Dictionary of boost scores for text fields. Keys are field names and values are the boost scores.
             num_results (int): The number of top results to return. Defaults to 10.
 
         Returns:
             list of dict: List of documents matching the search criteria, ranked by relevance.
         """
-        query_vecs = {field: self.vectorizers[field].transform([query]) for field in self.text_fields}
-        scores = np.zeros(len(self.docs))
+        self._refresh_if_stale()
+        query_vec = self._query_matrix([query], boost_dict)
+        rows, _ = self._score(query_vec, filter_dict, num_results)
 
-        # Compute cosine similarity for each text field and apply boost
-        for field, query_vec in query_vecs.items():
-            sim = cosine_similarity(query_vec, self.text_matrices[field]).flatten()
-            boost = boost_dict.get(field, 1)
-            scores += sim * boost
+        return [self.docs[row] for row in rows]
 
-        # Apply keyword filters
-        for field, value in filter_dict.items():
-            if field in self.keyword_fields:
-                mask = self.keyword_df[field] == value
-                scores = scores * mask.to_numpy()
+    def field_scores(self, query, doc_ids, boost_dict={}):
+        """
+        Splits the scores of documents for a query by text field, to tell which fields matched.
 
-        # Use argpartition to get top num_results indices
-        top_indices = np.argpartition(scores, -num_results)[-num_results:]
-        top_indices = top_indices[np.argsort(-scores[top_indices])]
+        Args:
+            query (str): The search query string.
+            doc_ids (list): Values of id_field of the documents to score.
+            boost_dict (dict): Dictionary of boost scores for text fields, as in search().
 
-        # Filter out zero-score results
-        top_docs = [self.docs[i] for i in top_indices if scores[i] > 0]
+        Returns:
+            np.ndarray: Contribution of each text field to each document's score, of shape
+                (len(doc_ids), len(text_fields)); a row sums to the score search() ranks the
+                document by. Documents that are not indexed (any more) get a row of zeros.
+        """
+        self._refresh_if_stale()
+        query_vec = self._query_matrix([query], boost_dict)
+        rows = [self.id_rows.get(doc_id) for doc_id in doc_ids]
+        return self._field_scores(query_vec, rows)
+
+    def field_similarities(self, queries):
+        """
+        Computes the cosine similarity of queries to every document, field by field, before boosts.
+
+        search() with any boost_dict ranks documents by the boost-weighted sum over the last
+        axis, so boosts can be tuned with weighted sums instead of searching again.
+
+        Args:
+            queries (list of str): The search query strings.
+
+        Returns:
+            np.ndarray: Similarities of shape (len(queries), n_rows, len(text_fields)). Rows are
+                in index order (see id_rows); deleted rows are all zeros.
+        """
+        self._refresh_if_stale()
+        # Without boosts the query is scaled by 1 / fit_boosts, which undoes the fitted ones
+        query_matrix = self._query_matrix(queries, {})
+        similarities = np.zeros((len(queries), self.matrix.shape[0], len(self.text_fields)))
+        for field in range(len(self.text_fields)):
+            columns = np.flatnonzero(self.column_field == field)
+            similarities[:, :, field] = (query_matrix[:, columns] @ self.matrix[:, columns].T).toarray()
+        return similarities
+
+    def _field_scores(self, query_vec, rows):
+        scores = np.zeros((len(rows), len(self.text_fields)))
+        present = [i for i, row in enumerate(rows) if row is not None]
+        if not present:
+            return scores
+
+        # The products summed by the mat-vec in _score(), summed per field instead
+        doc_rows = self.matrix[[rows[i] for i in present]]
+        query = np.zeros(query_vec.shape[1])
+        query[query_vec.indices] = query_vec.data
+        products = doc_rows.data * query[doc_rows.indices]
+        product_rows = np.repeat(np.array(present), np.diff(doc_rows.indptr))
+        np.add.at(scores, (product_rows, self.column_field[doc_rows.indices]), products)
+        return scores
+
+    def search_batch(self, queries, filter_dict={}, boost_dict={}, num_results=10):
+        """
+        Searches the index with many queries at once, sharing filters and boost parameters.
+
+        All queries are vectorized together and scored with one sparse matrix-matrix product,
+        which is much faster than calling search() in a loop for offline evaluation. Every
+        document that passes the filters is scored, whether or not the index keeps posting lists.
+
+        Args:
+            queries (list of str): The search query strings.
+            filter_dict (dict): Dictionary of keyword fields to filter by, as in search().
+            boost_dict (dict): Dictionary of boost scores for text fields. Keys are field names and values are the boost scores.
+            num_results (int): The number of top results to return per query. Defaults to 10.
+
+        Returns:
+            list of list of dict: For each query, the documents search() would return for it.
+        """
+        if not queries:
+            return []
+
+        self._refresh_if_stale()
+        query_matrix = self._query_matrix(queries, boost_dict)
+
+        # Apply keyword filters: only the rows that pass them are scored
+        rows = self._filter_rows(filter_dict)
+        if rows is not None:
+            scores = (query_matrix @ self.matrix[rows].T).toarray()
+        else:
+            scores = (query_matrix @ self.matrix.T).toarray()
+
+        # Row-wise top-k: one partition over the whole score matrix finds every row's cut-off
+        num_results = min(num_results, scores.shape[1])
+        if num_results <= 0:
+            return [[] for _ in queries]
+        kth_scores = np.partition(scores, -num_results, axis=1)[:, -num_results]
+
+        return [
+            [self.docs[row] for row in self._top_rows(row_scores, num_results, rows, kth_score)[0]]
+            for row_scores, kth_score in zip(scores, kth_scores)
+        ]
+
+
+class SegmentedIndex:
+    """
+    Serves an Index while documents are added, updated and deleted, without blocking searches.
+
+    New documents go to small in-memory segments that share the main index's columns and
+    IDF weights, so one query vector scores the main index and every segment, and their
+    results are merged by score. Deleting a document of the main index only records its row.
+    merge(), which start() runs on a background thread, folds the segments and deletions
+    into a copy of the main index and swaps it in.
+
+    Searches read one snapshot of (main index, segments, deleted rows) and take no lock;
+    writers and the swap replace the snapshot as a whole under a lock. Until the next merge,
+    terms the main index has never seen are not searchable in the new documents, so adding
+    or updating documents with such terms requests a merge right away.
+
+    Attributes:
+        max_segments (int): Number of segments that triggers a merge on the background thread.
+        merge_interval (float): Seconds between background merges.
+        generation (int): Number of add(), update() and delete() calls so far. Merges keep it,
+            since they do not change what is indexed.
+    """
+
+    def __init__(self, index, max_segments=8, merge_interval=60.0):
+        """
+        Initializes the SegmentedIndex around a fitted index.
+
+        Args:
+            index (Index): The fitted main index. It is only read from, never modified.
+            max_segments (int): Number of segments that triggers a merge on the background thread.
+            merge_interval (float): Seconds between background merges.
+        """
+        index._refresh_if_stale()
+        self.max_segments = max_segments
+        self.merge_interval = merge_interval
+        self.generation = 0
+
+        self._state = (index, (), frozenset())
+        self._lock = threading.Lock()
+        self._merge_lock = threading.Lock()
+        self._merge_requested = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def index(self):
+        """The current main index."""
+        return self._state[0]
+
+    @property
+    def segments(self):
+        """The segments not merged into the main index yet."""
+        return self._state[1]
+
+    def start(self):
+        """
+        Starts merging on a background thread, unless it is running already.
+
+        A forked child process does not inherit the parent's thread, so calling start()
+        again in the child starts its own.
+
+        Returns:
+            SegmentedIndex: self, so it can be chained after the constructor.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return self
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopped.clear()
+                self._thread = threading.Thread(target=self._merge_loop, name='minsearch-merge', daemon=True)
+                self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops the background thread, waiting for a running merge to finish.
+        """
+        if self._thread is not None:
+            self._stopped.set()
+            self._merge_requested.set()
+            self._thread.join()
+            self._thread = None
+
+    def add(self, docs):
+        """
+        Adds documents in a new segment. They are searchable as soon as this returns.
+
+        Args:
+            docs (list of dict): Documents to add. Each document is a dictionary.
+        """
+        if not docs:
+            return
+        with self._lock:
+            main, segments, deleted = self._state
+            for doc in docs:
+                if self._locate(doc.get(main.id_field)) is not None:
+                    raise ValueError(f"A document with {main.id_field}={doc[main.id_field]!r} is already indexed")
+
+            segments = segments + (main._segment(docs),)
+            self._state = (main, segments, deleted)
+            self.generation += 1
+
+        if len(segments) >= self.max_segments or main._has_new_terms(docs):
+            self._merge_requested.set()
+
+    def update(self, doc_id, doc):
+        """
+        Replaces the document with the given id.
+
+        Args:
+            doc_id: Value of id_field of the document to replace.
+            doc (dict): The new document.
+        """
+        with self._lock:
+            self._delete(doc_id)
+            main, segments, deleted = self._state
+            self._state = (main, segments + (main._segment([doc]),), deleted)
+            self.generation += 1
+
+        if len(segments) + 1 >= self.max_segments or main._has_new_terms([doc]):
+            self._merge_requested.set()
+
+    def upsert(self, docs):
+        """
+        Replaces the documents that are indexed already and adds the others, all in one segment.
+
+        Unlike calling update() for each document, a batch of any size adds one segment, and
+        searches see either none or all of it.
+
+        Args:
+            docs (list of dict): New versions of documents, identified by id_field.
+        """
+        if not docs:
+            return
+        with self._lock:
+            for doc in docs:
+                if self._locate(doc.get(self.index.id_field)) is not None:
+                    self._delete(doc[self.index.id_field])
+            main, segments, deleted = self._state
+            segments = segments + (main._segment(docs),)
+            self._state = (main, segments, deleted)
+            self.generation += 1
+
+        if len(segments) >= self.max_segments or main._has_new_terms(docs):
+            self._merge_requested.set()
+
+    def delete(self, doc_id):
+        """
+        Removes the document with the given id.
+
+        Args:
+            doc_id: Value of id_field of the document to remove.
+        """
+        with self._lock:
+            self._delete(doc_id)
+            self.generation += 1
+
+    def merge(self):
+        """
+        Folds the segments and deletions into a new main index and swaps it in.
+
+        The new main index is built from a copy while searches and writes go on. Only the
+        swap takes the writer lock, and it replays the changes made during the merge.
+
+        Returns:
+            bool: Whether there was anything to merge.
+        """
+        with self._merge_lock:
+            with self._lock:
+                main, segments, deleted = self._state
+                merged = [(segment, segment.live.copy()) for segment in segments]
+            if not segments and not deleted:
+                return False
+
+            new_main = copy.deepcopy(main)
+            for row in deleted:
+                new_main.delete(main.docs[row][main.id_field])
+            new_main.add([segment.docs[row] for segment, live in merged for row in np.flatnonzero(live)])
+            new_main._compact()
+
+            with self._lock:
+                _, current_segments, current_deleted = self._state
+
+                # Replay what was deleted from the merged data in the meantime
+                for row in current_deleted - deleted:
+                    new_main.delete(main.docs[row][main.id_field])
+                for segment, live in merged:
+                    for row in np.flatnonzero(live & ~segment.live):
+                        new_main.delete(segment.docs[row][segment.id_field])
+
+                # Segments added in the meantime are reindexed against the new columns
+                new_segments = tuple(
+                    new_main._segment([segment.docs[row] for row in np.flatnonzero(segment.live)])
+                    for segment in current_segments[len(segments):]
+                )
+                self._state = (new_main, new_segments, frozenset())
+
+        return True
+
+    def search(self, query, filter_dict={}, boost_dict={}, num_results=10):
+        """
+        Searches the main index and every segment, as Index.search() does.
+
+        Args:
+            query (str): The search query string.
+            filter_dict (dict): Dictionary of keyword fields to filter by, as in Index.search().
+            boost_dict (dict): Dictionary of boost scores for text fields. Keys are field names and values are the boost scores.
+            num_results (int): The number of top results to return. Defaults to 10.
+
+        Returns:
+            list of dict: List of documents matching the search criteria, ranked by relevance.
+        """
+        if num_results <= 0:
+            return []
+        main, segments, deleted = self._state
+        query_vec = main._query_matrix([query], boost_dict)
+
+        # Deleted rows are only dropped after ranking, so rank enough to make up for them
+        rows, scores = main._score(query_vec, filter_dict, num_results + len(deleted))
+        results = [(-score, 0, row, main.docs[row]) for row, score in zip(rows, scores) if row not in deleted]
+        for i, segment in enumerate(segments, 1):
+            rows, scores = segment._score(query_vec, filter_dict, num_results)
+            results.extend((-score, i, row, segment.docs[row]) for row, score in zip(rows, scores))
+
+        results.sort(key=lambda result: result[:3])
+        return [doc for *_, doc in results[:num_results]]
+
+    def field_scores(self, query, doc_ids, boost_dict={}):
+        """
+        Splits the scores of documents for a query by text field, as Index.field_scores() does,
+        wherever in the main index or the segments the documents are.
+        """
+        main, segments, deleted = self._state
+        query_vec = main._query_matrix([query], boost_dict)
+
+        scores = np.zeros((len(doc_ids), len(main.text_fields)))
+        for index in (main,) + segments:
+            rows = [index.id_rows.get(doc_id) for doc_id in doc_ids]
+            if index is main:
+                rows = [None if row in deleted else row for row in rows]
+            # A document lives in one place only, so the others contribute rows of zeros
+            scores += index._field_scores(query_vec, rows)
+        return scores
+
+    def _locate(self, doc_id):
+        """
+        Finds the live document with the given id.
+
+        Returns:
+            tuple: The segment holding it, or None for the main index, and its row; None if there is no such document.
+        """
+        main, segments, deleted = self._state
+        for segment in segments:
+            if doc_id in segment.id_rows:
+                return segment, segment.id_rows[doc_id]
+        row = main.id_rows.get(doc_id)
+        if row is not None and row not in deleted:
+            return None, row
+        return None
+
+    def _delete(self, doc_id):
+        # Callers hold the writer lock
+        location = self._locate(doc_id)
+        if location is None:
+            raise KeyError(f"No document with {self.index.id_field}={doc_id!r}")
+
+        segment, row = location
+        if segment is not None:
+            segment.delete(doc_id)
+        else:
+            main, segments, deleted = self._state
+            self._state = (main, segments, deleted | {row})
 
-        return top_docs
\ No newline at end of file
+    def _merge_loop(self):
+        while not self._stopped.is_set():
+            self._merge_requested.wait(self.merge_interval)
+            self._merge_requested.clear()
+            if self._stopped.is_set():
+                break
+            try:
+                self.merge()
+            except Exception:
+                logger.exception("Merging index segments failed")
@@ -0,0 +1,294 @@
+import logging
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from travel_guide import fakes
+
+logger = logging.getLogger(__name__)
+
+# 连接超时和读取超时（秒）。总耗时还受 generator.STAGE_TIMEOUTS 限制
+CONNECT_TIMEOUT = float(os.getenv("PLANNER_CONNECT_TIMEOUT", "3"))
+READ_TIMEOUT = float(os.getenv("PLANNER_READ_TIMEOUT", "5"))
+# 连接失败、超时、429 和 5xx 时的重试次数，两次重试之间随机等待 0 到 base * 2^n 秒（full jitter）
+RETRIES = int(os.getenv("PLANNER_RETRIES", "2"))
+RETRY_BACKOFF = float(os.getenv("PLANNER_RETRY_BACKOFF", "0.5"))
+RETRY_BACKOFF_MAX = 4.0
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# 连续失败这么多次后熔断，期间直接报错不再请求，过 BREAKER_RESET 秒后放一个请求试探
+BREAKER_FAILURES = int(os.getenv("PLANNER_BREAKER_FAILURES", "5"))
+BREAKER_RESET = float(os.getenv("PLANNER_BREAKER_RESET", "30"))
+# 每个主机保持的 keep-alive 连接数，和 generator 线程池的线程数同一量级
+POOL_SIZE = int(os.getenv("PLANNER_POOL_SIZE", "10"))
+
+
+def fixture_path(url):
+    # 录制的响应按主机和路径存放，忽略查询参数：fixtures/http/<主机>/<路径>.json
+    parts = urlsplit(url)
+    path = parts.path.strip("/")
+    if not path.endswith(".json"):
+        path += ".json"
+    return os.path.join(fakes.FIXTURES_PATH, "http", parts.hostname, path)
+
+
+class FixtureAdapter(BaseAdapter):
+    """
+    不访问网络，用录制的响应回答请求，按 fixtures/services.json 中该主机的配置模拟延迟和错误。
+    超过读取超时的延迟会抛出 ReadTimeout，和真实接口一样触发重试和熔断。没有录制的路径返回 404。
+    """
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        host = urlsplit(request.url).hostname
+        config = fakes.service_config(host)
+        latency = fakes.sample_latency(config)
+        read_timeout = timeout[1] if isinstance(timeout, tuple) else timeout
+        if read_timeout is not None and latency > read_timeout:
+            time.sleep(read_timeout)
+            raise requests.ReadTimeout(f"模拟的 {host} 超过 {read_timeout}s 没有响应", request=request)
+        time.sleep(latency)
+
+        status = fakes.sample_error(config)
+        if status is None:
+            try:
+                with open(fixture_path(request.url), "rb") as f:
+                    status, content = 200, f.read()
+            except FileNotFoundError:
+                status, content = 404, b'{"error": "no fixture recorded for this path"}'
+        else:
+            content = b'{"error": "injected by FixtureAdapter"}'
+
+        response = requests.Response()
+        response.status_code = status
+        response._content = content
+        response.headers["Content-Type"] = "application/json"
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        response.reason = "OK" if status == 200 else "Fake Error"
+        return response
+
+    def close(self):
+        pass
+
+
+class RecordingAdapter(HTTPAdapter):
+    """
+    照常请求真实接口，同时把成功的响应保存为 FixtureAdapter 回放用的录制文件。
+    令牌接口的响应里有真实的 access_token，提交录制文件前要替换掉。
+    """
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        if response.status_code == 200:
+            path = fixture_path(request.url)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(response.content)
+        return response
+
+
+class CircuitOpenError(RuntimeError):
+    """熔断期间的请求直接失败，不会发到第三方接口。"""
+
+
+class CircuitBreaker:
+    """
+    连续失败 failure_threshold 次后打开，reset_timeout 秒内的请求都直接失败；
+    之后放行一个试探请求，成功则恢复，失败则重新打开。
+    """
+
+    def __init__(self, failure_threshold=BREAKER_FAILURES, reset_timeout=BREAKER_RESET):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            # 半开状态：超过 reset_timeout 后只放行一个试探请求
+            if not self._trial and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self._trial = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._trial = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if self._trial else "open"
+
+
+class ApiClient:
+    """
+    一个第三方接口主机的客户端：共享的 requests.Session（连接池复用 keep-alive 连接和 TLS 会话），
+    每个请求都有超时，失败时带随机退避重试，连续失败后熔断。
+
+    参数：
+        name (str): 接口名，用于日志和报错。
+        base_url (str): 主机地址，请求时传入的相对路径会拼在后面。
+        timeout (tuple): (连接超时, 读取超时)，单位秒。
+        retries (int): 最多重试次数。
+        breaker (CircuitBreaker, optional): 熔断器，默认每个客户端一个。
+    """
+
+    def __init__(self, name, base_url, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), retries=RETRIES,
+                 breaker=None):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.retries = retries
+        self.breaker = breaker or CircuitBreaker()
+
+        self.session = requests.Session()
+        if fakes.FAKE_SERVICES == "replay":
+            adapter = FixtureAdapter()
+        elif fakes.FAKE_SERVICES == "record":
+            adapter = RecordingAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+        else:
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, method, path, **kwargs):
+        """
+        发送请求并返回 requests.Response。4xx（429 除外）等不需要重试的响应原样返回，由调用方处理。
+
+        异常：
+            CircuitOpenError: 熔断中。
+            requests.RequestException: 重试用完后仍然连接失败或超时，或者不可重试的请求错误。
+        """
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"{self.name} 连续请求失败，暂停请求 {self.breaker.reset_timeout}s")
+
+        url = path if path.startswith("http") else f"{self.base_url}{path}"
+        kwargs.setdefault("timeout", self.timeout)
+
+        for attempt in range(self.retries + 1):
+            last_attempt = attempt == self.retries
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if last_attempt:
+                    self.breaker.record_failure()
+                    raise
+                logger.warning("%s %s failed (%r), retrying", self.name, method, e)
+            except requests.RequestException:
+                # 其他请求错误（重定向过多、URL 无效等）重试也没用，但同样要记一次失败，
+                # 否则试探请求遇到它时熔断器会一直停在半开状态
+                self.breaker.record_failure()
+                raise
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    self.breaker.record_success()
+                    return response
+                if last_attempt:
+                    self.breaker.record_failure()
+                    return response
+                logger.warning("%s %s returned %s, retrying", self.name, method, response.status_code)
+
+            time.sleep(random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * 2 ** attempt)))
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+
+class TokenFetch:
+    """一次进行中的令牌请求：等待它的线程在 done 之后取 token，失败时取 error。"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.token = None
+        self.error = None
+
+
+class TokenCache:
+    """
+    OAuth2 client credentials 令牌缓存：同一组凭证的令牌在过期前重复使用，并发请求只取一次。
+
+    令牌接口在锁外请求，重试和退避期间其他凭证的请求照常进行；
+    同一凭证的并发请求等待进行中的那一次，共用它的令牌或错误。
+
+    参数：
+        client (ApiClient): 令牌接口所在主机的客户端。
+        token_path (str): 令牌接口路径。
+        margin (float): 提前这么多秒视为过期，避免令牌在请求途中失效。
+    """
+
+    def __init__(self, client, token_path, margin=60):
+        self.client = client
+        self.token_path = token_path
+        self.margin = margin
+        self._tokens = {}
+        self._fetches = {}
+        self._lock = threading.Lock()
+
+    def get(self, client_id, client_secret):
+        with self._lock:
+            token, expires_at = self._tokens.get(client_id, (None, 0))
+            if token is not None and time.monotonic() < expires_at:
+                return token
+            fetch = self._fetches.get(client_id)
+            leader = fetch is None
+            if leader:
+                fetch = self._fetches[client_id] = TokenFetch()
+
+        if not leader:
+            fetch.done.wait()
+            if fetch.error is not None:
+                raise fetch.error
+            return fetch.token
+
+        try:
+            fetch.token, expires_at = self._fetch(client_id, client_secret)
+            with self._lock:
+                self._tokens[client_id] = (fetch.token, expires_at)
+            return fetch.token
+        except Exception as e:
+            fetch.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._fetches[client_id]
+            fetch.done.set()
+
+    def _fetch(self, client_id, client_secret):
+        response = self.client.post(
+            self.token_path,
+            headers={"Content-Type": "application/x-www-form-urlencoded"},
+            data={
+                "grant_type": "client_credentials",
+                "client_id": client_id,
+                "client_secret": client_secret,
+            },
+        )
+        response.raise_for_status()
+        body = response.json()
+        return body["access_token"], time.monotonic() + float(body.get("expires_in", 0)) - self.margin
+
+    def invalidate(self, client_id):
+        with self._lock:
+            self._tokens.pop(client_id, None)
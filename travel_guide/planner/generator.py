@@ -2,31 +2,128 @@ from datetime import datetime, timedelta
 import logging
 from dotenv import load_dotenv
 import os
-import requests
+import threading
+import time
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as StageTimeout
+from travel_guide.cache import MemoryBackend, SQLiteBackend
+from travel_guide.planner.clients import ApiClient, TokenCache
 from travel_guide.rag import llm
 import json
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# 各阶段的超时时间（秒）。超时或出错的阶段用空结果代替，计划照常生成
+STAGE_TIMEOUTS = {
+    "weather": 10,
+    "flights": 15,
+    "hotels": 10,
+    "attractions": 20,
+    "foods": 20,
+}
+
+# 同时生成的计划数上限。线程池按这个并发量配置，每个计划的各阶段都有线程可用；
+# 超出上限的计划最多等待 PLANNER_QUEUE_TIMEOUT 秒，仍没有空位就报 PlannerBusyError，而不是让各阶段排队超时
+PLANNER_MAX_PLANS = int(os.getenv("PLANNER_MAX_PLANS", "10"))
+PLANNER_QUEUE_TIMEOUT = float(os.getenv("PLANNER_QUEUE_TIMEOUT", "10"))
+
+# 各阶段互不依赖，在同一个线程池里并发执行；超时的阶段会继续占用线程直到返回，所以多留一倍线程
+_executor = ThreadPoolExecutor(max_workers=2 * PLANNER_MAX_PLANS * len(STAGE_TIMEOUTS), thread_name_prefix="planner")
+_plan_slots = threading.BoundedSemaphore(PLANNER_MAX_PLANS)
+
+
+class PlannerBusyError(RuntimeError):
+    """同时生成的计划已达 PLANNER_MAX_PLANS 个，等待 PLANNER_QUEUE_TIMEOUT 秒后仍没有空位。"""
+
+# 每个第三方接口一个共享客户端，复用连接，带超时、重试和熔断
+weather_api = ApiClient("openweathermap", "http://api.openweathermap.org")
+amadeus_api = ApiClient("amadeus", "https://test.api.amadeus.com")
+hotellook_api = ApiClient("hotellook", "https://engine.hotellook.com")
+# Amadeus 的令牌有效期约半小时，过期前一直复用
+amadeus_token = TokenCache(amadeus_api, "/v1/security/oauth2/token")
+
+# 第三方接口响应的缓存："memory" 只在本进程内，"sqlite" 由同一台机器上的所有 worker 共享
+PLANNER_CACHE = os.getenv("PLANNER_CACHE", "memory")
+PLANNER_CACHE_PATH = os.getenv("PLANNER_CACHE_PATH", "./data/planner_cache.sqlite")
+PLANNER_CACHE_SIZE = int(os.getenv("PLANNER_CACHE_SIZE", "1000"))
+# 各接口响应的有效期（秒），0 表示一直有效直到被淘汰。
+# 城市坐标不会变；天气预报每 3 小时更新一次，缓存键按 3 小时分桶；航班价格变化快，酒店慢一些
+CACHE_TTLS = {
+    "geocode": 0,
+    "forecast": 3 * 3600,
+    "flights": 30 * 60,
+    "hotels": 6 * 3600,
+}
+FORECAST_BUCKET = 3 * 3600
+
+
+def create_response_caches(kind=PLANNER_CACHE):
+    if kind == "off":
+        return {}
+    if kind == "sqlite":
+        return {endpoint: SQLiteBackend(PLANNER_CACHE_PATH, PLANNER_CACHE_SIZE, ttl, table=endpoint)
+                for endpoint, ttl in CACHE_TTLS.items()}
+    if kind == "memory":
+        return {endpoint: MemoryBackend(PLANNER_CACHE_SIZE, ttl) for endpoint, ttl in CACHE_TTLS.items()}
+    raise ValueError(f"未知的 PLANNER_CACHE {kind!r}，可选 'memory'、'sqlite'、'off'")
+
+
+_response_caches = create_response_caches()
+
+
+def cached_response(endpoint, key_parts, fetch, cacheable=None):
+    """
+    返回 endpoint 接口以 key_parts 为键的缓存响应；没有缓存时调用 fetch() 请求并缓存。
+    出错的请求不缓存；给了 cacheable 时，cacheable(响应) 为假的响应也不缓存。
+    """
+    backend = _response_caches.get(endpoint)
+    if backend is None:
+        return fetch()
+
+    key = json.dumps(key_parts, ensure_ascii=False)
+    value = backend.get(key)
+    if value is None:
+        value = fetch()
+        if cacheable is None or cacheable(value):
+            backend.set(key, value)
+    return value
+
+
+def found_cities(cities):
+    # 地理编码的结果永久缓存，所以空结果和 200 状态码下返回的错误对象都不缓存，下次重新查询
+    return isinstance(cities, list) and len(cities) > 0
+
+
+def get_json(client, url, **kwargs):
+    response = client.get(url, **kwargs)
+    if response.status_code != 200:
+        raise Exception(f"请求失败：{response.status_code} {response.text}")
+    return response.json()
+
+
 def query_weather(destination, target_date, days):
     # 获取城市地理信息
     api_key= os.environ.get("WEATHER_API_KEY")
-    city_url = f"http://api.openweathermap.org/geo/1.0/direct?q={destination}&limit={5}&appid={api_key}"
-    response = requests.get(city_url)
-    if response.status_code != 200:
-        raise Exception(f"请求失败：{response.status_code} {response.text}")
-    city = response.json()[0]
+    city_url = f"/geo/1.0/direct?q={destination}&limit={5}&appid={api_key}"
+    cities = cached_response(
+        "geocode",
+        [destination.strip().lower()],
+        lambda: get_json(weather_api, city_url),
+        cacheable=found_cities,
+    )
+    city = cities[0]
     lat = city["lat"]
     lon = city["lon"]
 
     # 你要哪一天的预报？
-    temper_url = f"http://api.openweathermap.org/data/2.5/forecast?lat={lat}&lon={lon}&appid={api_key}"
-    response = requests.get(temper_url)
-    if response.status_code != 200:
-        raise Exception(f"请求失败：{response.status_code} {response.text}")
-    
-    weather = response.json()
+    temper_url = f"/data/2.5/forecast?lat={lat}&lon={lon}&appid={api_key}"
+    weather = cached_response(
+        "forecast",
+        [round(lat, 2), round(lon, 2), int(time.time() // FORECAST_BUCKET)],
+        lambda: get_json(weather_api, temper_url),
+    )
     # 从start date 开始到start date + days 结束期间的天气信息
     # 重点提取下雨信息，高温信息， 低温信息
     forecast_list = weather['list']
@@ -82,24 +179,8 @@ def suggest_transport(trip_info):
     if not client_id or not client_secret:
         raise ValueError("未找到 AIR_API_KEY 或 AIR_API_SECRET，请确认 .env 文件配置")
 
-    # Step 1: 获取 access_token
-    token_url = "https://test.api.amadeus.com/v1/security/oauth2/token"
-    headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    data = {
-        "grant_type": "client_credentials",
-        "client_id": client_id,
-        "client_secret": client_secret
-    }
-    token_res = requests.post(token_url, headers=headers, data=data)
-    # ?
-    token_res.raise_for_status()
-    #  =if token_res.status_code >= 400:
-    # raise Exception("请求失败")
-    access_token = token_res.json()["access_token"]
-
-    # Step 2: 调用航班搜索接口
-    search_url = "https://test.api.amadeus.com/v2/shopping/flight-offers"
-    search_headers = {"Authorization": f"Bearer {access_token}"}
+    # 同一航线同一天的搜索结果各用户共用
+    search_url = "/v2/shopping/flight-offers"
     params = {
         "originLocationCode": get_iata(trip_info["origin"]),
         "destinationLocationCode": get_iata(trip_info["destination"]),
@@ -107,9 +188,26 @@ def suggest_transport(trip_info):
         "adults": 1,
         "max": 10
     }
-    response = requests.get(search_url, headers=search_headers, params=params)
-    response.raise_for_status()
-    offers = response.json().get("data", [])
+
+    def search_flights():
+        # Step 1: 获取 access_token（缓存到过期前）
+        access_token = amadeus_token.get(client_id, client_secret)
+
+        # Step 2: 调用航班搜索接口
+        response = amadeus_api.get(search_url, headers={"Authorization": f"Bearer {access_token}"}, params=params)
+        if response.status_code == 401:
+            # 令牌提前失效（比如被吊销），重新获取一次
+            amadeus_token.invalidate(client_id)
+            access_token = amadeus_token.get(client_id, client_secret)
+            response = amadeus_api.get(search_url, headers={"Authorization": f"Bearer {access_token}"}, params=params)
+        response.raise_for_status()
+        return response.json().get("data", [])
+
+    offers = cached_response(
+        "flights",
+        [params["originLocationCode"], params["destinationLocationCode"], params["departureDate"]],
+        search_flights,
+    )
 
     # Step 3: 提取关键信息
     results = []
@@ -139,7 +237,7 @@ def suggest_transport(trip_info):
 
 
 def suggest_hotels(location, start_date, end_date):
-    url = "https://engine.hotellook.com/api/v2/cache.json"
+    url = "/api/v2/cache.json"
     params = {
         "location": location,
         "checkIn": start_date,
@@ -148,7 +246,11 @@ def suggest_hotels(location, start_date, end_date):
         "limit": 20
     }
 
-    response = requests.get(url, params=params).json()
+    response = cached_response(
+        "hotels",
+        [location, start_date, end_date],
+        lambda: get_json(hotellook_api, url, params=params),
+    )
     hotels = []
     for hotel in response:
         hotels.append({
@@ -289,6 +391,58 @@ def suggest_diet(trip_info):
 
 
 
+def run_stages(stages, fallbacks, timeouts=STAGE_TIMEOUTS):
+    """
+    并发执行互不依赖的各阶段，总耗时取决于最慢（或超时）的那个阶段。
+
+    stages: {阶段名: 无参函数}
+    fallbacks: {阶段名: 超时或出错时使用的结果}
+    返回 {阶段名: 结果}
+
+    异常：
+        PlannerBusyError: 同时生成的计划太多。
+    """
+    if not _plan_slots.acquire(timeout=PLANNER_QUEUE_TIMEOUT):
+        raise PlannerBusyError(f"已有 {PLANNER_MAX_PLANS} 个计划在生成，请稍后再试")
+    try:
+        return _run_stages(stages, fallbacks, timeouts)
+    finally:
+        _plan_slots.release()
+
+
+def _run_stages(stages, fallbacks, timeouts):
+    started = {name: threading.Event() for name in stages}
+    start_times = {}
+
+    def run(name, stage):
+        start_times[name] = time.monotonic()
+        started[name].set()
+        return stage()
+
+    futures = {name: _executor.submit(run, name, stage) for name, stage in stages.items()}
+
+    results = {}
+    for name, future in futures.items():
+        # 截止时间从阶段开始执行算起，不含在线程池里排队的时间。
+        # 线程被之前超时的阶段占满时，最多排队一个超时时长，仍未开始就放弃
+        if not started[name].wait(timeouts[name]) and future.cancel():
+            logger.warning("Stage %s did not start within %ss, continuing without it", name, timeouts[name])
+            results[name] = fallbacks[name]
+            continue
+        started[name].wait()
+        remaining = timeouts[name] - (time.monotonic() - start_times[name])
+        try:
+            results[name] = future.result(timeout=max(remaining, 0))
+        except StageTimeout:
+            logger.warning("Stage %s timed out after %ss, continuing without it", name, timeouts[name])
+            results[name] = fallbacks[name]
+        except Exception:
+            logger.exception("Stage %s failed, continuing without it", name)
+            results[name] = fallbacks[name]
+
+    return results
+
+
 def generate_full_plan(trip_info):
     from travel_guide.rag import llm
     from datetime import datetime, timedelta
@@ -306,12 +460,22 @@ def generate_full_plan(trip_info):
     except Exception:
         start_date, end_date = "未知", "未知"
 
-    # 各模块信息收集
-    weather_info = query_weather(destination, date, days)
-    flights = suggest_transport(trip_info)
-    hotels = suggest_hotels(destination, date, end_date.strftime("%Y-%m-%d"))
-    attractions = suggest_attractions(trip_info)
-    foods = suggest_diet(trip_info)
+    # 各模块信息并发收集，某个接口慢或失败时只缺少这一部分
+    results = run_stages(
+        stages={
+            "weather": lambda: query_weather(destination, date, days),
+            "flights": lambda: suggest_transport(trip_info),
+            "hotels": lambda: suggest_hotels(destination, date, end_date.strftime("%Y-%m-%d")),
+            "attractions": lambda: suggest_attractions(trip_info),
+            "foods": lambda: suggest_diet(trip_info),
+        },
+        fallbacks={"weather": {}, "flights": [], "hotels": [], "attractions": "[]", "foods": "[]"},
+    )
+    weather_info = results["weather"]
+    flights = results["flights"]
+    hotels = results["hotels"]
+    attractions = results["attractions"]
+    foods = results["foods"]
 
     # 构造 prompt
     prompt = f"""
@@ -1,11 +1,194 @@
-from sentence_transformers import SentenceTransformer, util
-from travel_guide.preferences.schema import (
+import hashlib
+import json
+import os
+import sys
+from abc import ABC, abstractmethod
+from time import perf_counter
+
+import numpy as np
+
+try:
+    from travel_guide.lazy import Lazy
+except ImportError:
+    # 应用从 travel_guide/ 目录运行（见 Dockerfile），本包以 preferences 导入
+    from lazy import Lazy
+from .schema import (
     get_all_value_candidates,
     get_empty_preferences
 )
 
 
-model = SentenceTransformer('all-MiniLM-L6-v2')
+MODEL_NAME = 'all-MiniLM-L6-v2'
+
+# 编码后端："torch" 是原始的 PyTorch 模型；"onnx" 和 "onnx-int8"（int8 量化）用 ONNX Runtime
+# 在 CPU 上推理，更快、占内存更少，需要安装 sentence-transformers[onnx]。
+# 换后端前用 python -m travel_guide.preferences.classification <后端> 检查选出的偏好值是否一致
+EMBEDDING_BACKEND = os.getenv("PREFERENCE_EMBEDDING_BACKEND", "torch")
+# 模型仓库中的量化模型文件，avx2 版本大多数 x86 CPU 都能跑
+ONNX_INT8_FILE = os.getenv("PREFERENCE_ONNX_INT8_FILE", "onnx/model_quint8_avx2.onnx")
+
+# 候选样例向量的缓存目录，文件名带 schema 内容和模型名的哈希，schema 改了就会重新计算
+EMBEDDING_CACHE_DIR = os.getenv(
+    "PREFERENCE_EMBEDDING_CACHE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".embedding_cache"),
+)
+
+class CandidateMatrix:
+    """
+    所有候选样例的向量按字段顺序堆成一个矩阵，一次矩阵乘法就能算出与全部样例的相似度。
+
+    属性：
+        embeddings (np.ndarray): 归一化后的样例向量，形状 (样例数, 维度)，同一字段的样例相邻。
+        fields (list): 字段名，顺序与矩阵中的字段块一致。
+        starts (np.ndarray): 每个字段第一条样例所在的行。
+        values (list): 每一行样例对应的偏好值。
+    """
+
+    def __init__(self, embeddings, fields, starts, values):
+        self.embeddings = embeddings
+        self.fields = fields
+        self.starts = starts
+        self.values = values
+
+    def best_matches(self, query_embs, exclude_rows=None):
+        """
+        对每条文本、每个字段找出最相似的样例。
+
+        参数：
+            query_embs (np.ndarray): 归一化后的文本向量，形状 (文本数, 维度)。
+            exclude_rows (np.ndarray, optional): 每条文本不参与比较的样例行，用于拿样例本身做查询。
+
+        返回：
+            tuple: 每个字段的最高相似度和对应偏好值，形状都是 (文本数, 字段数)。
+        """
+        scores = query_embs @ self.embeddings.T
+        if exclude_rows is not None:
+            scores[np.arange(len(query_embs)), exclude_rows] = -np.inf
+        ends = list(self.starts[1:]) + [scores.shape[1]]
+
+        best_scores = np.empty((len(query_embs), len(self.fields)), dtype=scores.dtype)
+        best_values = np.empty((len(query_embs), len(self.fields)), dtype=object)
+        for i, (start, end) in enumerate(zip(self.starts, ends)):
+            # argmax 取第一个最大值，和逐条比较时 “严格大于才替换” 的结果一致
+            best = start + np.argmax(scores[:, start:end], axis=1)
+            best_scores[:, i] = scores[np.arange(len(query_embs)), best]
+            best_values[:, i] = [self.values[row] for row in best]
+
+        return best_scores, best_values
+
+
+class EmbeddingBackend(ABC):
+    """
+    编码后端的接口：把文本编码为归一化的 float32 向量。
+
+    属性：
+        name (str): 后端名称，不同后端的样例向量分开缓存。
+    """
+
+    name = None
+
+    @abstractmethod
+    def load(self):
+        """加载模型，返回模型对象。"""
+
+    @abstractmethod
+    def encode(self, texts):
+        """
+        参数：
+            texts (list of str): 要编码的文本。
+
+        返回：
+            np.ndarray: 归一化后的向量，形状 (文本数, 维度)，dtype 为 float32。
+        """
+
+
+class SentenceTransformerBackend(EmbeddingBackend):
+    """
+    用 sentence_transformers 加载 MODEL_NAME，model_kwargs 等参数原样传给 SentenceTransformer。
+    """
+
+    def __init__(self, name, **kwargs):
+        self.name = name
+        self.kwargs = kwargs
+        self._model = Lazy(self._load_model)
+
+    def _load_model(self):
+        # sentence_transformers 会导入 torch，耗时几秒，所以第一次编码时才导入并加载模型
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(MODEL_NAME, **self.kwargs)
+
+    def load(self):
+        return self._model()
+
+    def encode(self, texts):
+        return np.asarray(self.load().encode(texts, normalize_embeddings=True), dtype=np.float32)
+
+
+def create_embedding_backend(kind=EMBEDDING_BACKEND):
+    if kind == "torch":
+        return SentenceTransformerBackend(kind)
+    if kind == "onnx":
+        return SentenceTransformerBackend(kind, backend="onnx")
+    if kind == "onnx-int8":
+        return SentenceTransformerBackend(kind, backend="onnx", model_kwargs={"file_name": ONNX_INT8_FILE})
+    raise ValueError(f"未知的 PREFERENCE_EMBEDDING_BACKEND {kind!r}，可选 'torch'、'onnx'、'onnx-int8'")
+
+
+get_backend = Lazy(create_embedding_backend)
+
+
+def get_model():
+    return get_backend().load()
+
+
+def encode(texts):
+    return get_backend().encode(texts)
+
+
+def schema_hash(schema, backend_name):
+    content = json.dumps([MODEL_NAME, backend_name, schema], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+
+
+def flatten_schema(schema):
+    """按字段顺序展开 schema，返回字段名、每个字段第一条样例的行、所有样例和每条样例的偏好值。"""
+    fields = []
+    starts = []
+    examples = []
+    values = []
+    for field, value_map in schema.items():
+        fields.append(field)
+        starts.append(len(examples))
+        for val, example_list in value_map.items():
+            examples.extend(example_list)
+            values.extend([val] * len(example_list))
+    return fields, np.array(starts), examples, values
+
+
+def build_candidate_matrix(schema, backend=None):
+    backend = backend or get_backend()
+    fields, starts, examples, values = flatten_schema(schema)
+
+    path = os.path.join(EMBEDDING_CACHE_DIR, f"candidates-{schema_hash(schema, backend.name)}.npy")
+    if os.path.exists(path):
+        embeddings = np.load(path)
+    else:
+        # 所有样例一次批量编码
+        embeddings = backend.encode(examples)
+        os.makedirs(EMBEDDING_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, embeddings)
+        os.replace(tmp_path, path)
+
+    return CandidateMatrix(embeddings, fields, starts, values)
+
+
+def load_candidate_matrix():
+    return build_candidate_matrix(get_all_value_candidates())
+
+
+get_candidate_matrix = Lazy(load_candidate_matrix)
 
 
 def retrieve_preferences(text: str, existing=None, threshold=0.6) -> dict:
@@ -22,23 +205,109 @@ def retrieve_preferences(text: str, existing=None, threshold=0.6) -> dict:
         dict: 偏好字段到匹配值的字典（结构完整，仅更新空字段）。
     """
     preferences = existing.copy() if existing else get_empty_preferences()
-    query_emb = model.encode(text, convert_to_tensor=True)
-    schema = get_all_value_candidates()
+    candidates = get_candidate_matrix()
+    best_scores, best_values = candidates.best_matches(encode([text]))
 
-    for field, value_map in schema.items():
+    for field, best_score, best_value in zip(candidates.fields, best_scores[0], best_values[0]):
         if preferences.get(field):
             continue  # 跳过已有值字段
-
-        best_score = 0
-        best_value = ""
-        for val, example_list in value_map.items():
-            for example in example_list:
-                example_emb = model.encode(example, convert_to_tensor=True)
-                score = float(util.cos_sim(query_emb, example_emb))
-                if score > best_score:
-                    best_score = score
-                    best_value = val
         if best_score >= threshold:
             preferences[field] = best_value
 
-    return preferences
\ No newline at end of file
+    return preferences
+
+
+def retrieve_preferences_batch(texts, existing_list=None, threshold=0.6) -> list:
+    """
+    retrieve_preferences 的批量版本：所有文本一次批量编码，一次矩阵乘法与全部样例比较。
+
+    参数：
+        texts (list of str): 多个用户各自的偏好文本。
+        existing_list (list of dict, optional): 与 texts 一一对应的已填写偏好字典，元素可以为 None。
+        threshold (float): 相似度阈值，超过该值才会视为有效匹配。
+
+    返回：
+        list of dict: 与 texts 一一对应的偏好字典，结果与逐条调用 retrieve_preferences 相同。
+    """
+    if not texts:
+        return []
+    if existing_list is None:
+        existing_list = [None] * len(texts)
+    if len(existing_list) != len(texts):
+        raise ValueError("existing_list 的长度必须与 texts 相同")
+
+    candidates = get_candidate_matrix()
+    best_scores, best_values = candidates.best_matches(encode(list(texts)))
+
+    preferences_list = [existing.copy() if existing else get_empty_preferences() for existing in existing_list]
+    # 只补充尚未填写、且相似度达到阈值的字段
+    missing = np.array([[not preferences.get(field) for field in candidates.fields] for preferences in preferences_list])
+    fill = missing & (best_scores >= threshold)
+
+    for row, field_index in zip(*np.nonzero(fill)):
+        preferences_list[row][candidates.fields[field_index]] = best_values[row, field_index]
+
+    return preferences_list
+
+
+
+def compare_backends(reference, candidate, threshold=0.6):
+    """
+    检查换用另一个编码后端后，选出的偏好值是否不变。
+
+    每条候选样例轮流作为查询文本（不和它自己比较），分别用两个后端选出各字段的偏好值；
+    同时比较两个后端对同一样例编码的余弦相似度，以及逐条编码的平均耗时。
+
+    参数：
+        reference (EmbeddingBackend): 作为基准的后端，通常是 "torch"。
+        candidate (EmbeddingBackend): 要检查的后端。
+        threshold (float): 与 retrieve_preferences 相同的相似度阈值。
+
+    返回：
+        dict: 选值一致率、不一致的样例、向量相似度和两个后端逐条编码的平均耗时（毫秒）。
+    """
+    fields, starts, examples, values = flatten_schema(get_all_value_candidates())
+    rows = np.arange(len(examples))
+
+    embeddings = []
+    picked = []
+    latency_ms = []
+    for backend in (reference, candidate):
+        # 不读磁盘缓存，两个后端都重新编码
+        embs = backend.encode(examples)
+        best_scores, best_values = CandidateMatrix(embs, fields, starts, values).best_matches(embs, exclude_rows=rows)
+        # 低于阈值的字段不会被填写，和 retrieve_preferences 一样记为 None
+        best_values[best_scores < threshold] = None
+        embeddings.append(embs)
+        picked.append(best_values)
+
+        t0 = perf_counter()
+        for example in examples:
+            backend.encode([example])
+        latency_ms.append((perf_counter() - t0) / len(examples) * 1000)
+
+    cosine = np.sum(embeddings[0] * embeddings[1], axis=1)
+    mismatches = [
+        {"text": examples[row], "field": fields[col], reference.name: picked[0][row, col],
+         candidate.name: picked[1][row, col]}
+        for row, col in zip(*np.nonzero(picked[0] != picked[1]))
+    ]
+
+    return {
+        "agreement": 1 - len(mismatches) / picked[0].size,
+        "mismatches": mismatches,
+        "min_cosine": float(cosine.min()),
+        "mean_cosine": float(cosine.mean()),
+        f"{reference.name}_ms": latency_ms[0],
+        f"{candidate.name}_ms": latency_ms[1],
+    }
+
+
+if __name__ == "__main__":
+    # python -m travel_guide.preferences.classification onnx-int8
+    candidate_kind = sys.argv[1] if len(sys.argv) > 1 else "onnx-int8"
+    report = compare_backends(create_embedding_backend("torch"), create_embedding_backend(candidate_kind))
+    for mismatch in report.pop("mismatches"):
+        print("不一致:", mismatch)
+    print(json.dumps(report, indent=2))
+    sys.exit(1 if report["agreement"] < 1 else 0)
@@ -0,0 +1,97 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+from memory import rss_mb
+
+# Reports what starting the app costs: which modules take longest to import, then how long
+# each lazily created object (index, clients, models) takes to load and how much memory it adds.
+#   python profile_startup.py --module app --top 15
+
+parser = argparse.ArgumentParser(description="Profile import time and lazy loading of the app")
+parser.add_argument("--module", default="app", help="module to import, as the server would")
+parser.add_argument("--top", type=int, default=15, help="number of slowest imports to show")
+parser.add_argument("--no-load", action="store_true", help="only profile imports")
+args = parser.parse_args()
+
+
+def import_times(module):
+    # -X importtime writes "import time: self [us] | cumulative | package" lines to stderr,
+    # in a fresh interpreter so nothing is imported already
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        name = fields[2].rstrip()
+        # Nested imports are indented below the module that triggered them
+        depth = (len(name) - len(name.lstrip())) // 2
+        times.append((name.strip(), depth, int(fields[0]) / 1e6, int(fields[1]) / 1e6))
+    return times, result.returncode, result.stderr
+
+
+def measure(name, load):
+    rss_before = rss_mb()
+    t0 = time.perf_counter()
+    try:
+        load()
+    except Exception as e:
+        print(f"{name:<28} failed: {e!r}")
+        return
+    took = time.perf_counter() - t0
+    print(f"{name:<28} {took:8.3f}s {rss_mb() - rss_before:+9.1f} MB")
+
+
+times, returncode, stderr = import_times(args.module)
+if returncode != 0:
+    print(stderr.splitlines()[-1] if stderr else f"import {args.module} failed")
+    sys.exit(1)
+
+total = sum(self_time for _, _, self_time, _ in times)
+print(f"import {args.module}: {total:.3f}s, {len(times)} modules")
+print(f"\nslowest top-level imports (cumulative):")
+# Only top-level packages, so that a package and its submodules are not counted twice
+top_level = sorted(
+    ((name, cumulative) for name, depth, _, cumulative in times if "." not in name),
+    key=lambda item: -item[1],
+)
+for name, cumulative in top_level[:args.top]:
+    print(f"  {name:<40} {cumulative:8.3f}s")
+
+if args.no_load:
+    sys.exit(0)
+
+print("\nlazy loading (time, resident memory added):")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+measure(f"import {args.module}", lambda: __import__(args.module))
+
+import rag  # noqa: E402
+
+measure("search index", rag.search_index)
+measure("corpus digest", rag.corpus_digest)
+measure("answer caches", rag.answer_caches)
+measure("groq client", rag.get_client)
+measure("async groq client", rag.get_async_client)
+
+
+def load_preference_model():
+    # Imported as preferences.classification, like rag.py does, so the model is loaded once
+    from preferences.classification import get_model
+    get_model()
+
+
+def load_preference_candidates():
+    from preferences.classification import get_candidate_matrix
+    get_candidate_matrix()
+
+
+measure("preference model", load_preference_model)
+measure("preference candidates", load_preference_candidates)
@@ -1,37 +1,240 @@
+import gc
+import hashlib
 import json
+import logging
+import cache
+import fakes
 import ingest
+import metrics
 import os
-from groq import Groq
-from time import time
+import threading
+from lazy import Lazy
+from time import sleep, time
 
+logger = logging.getLogger(__name__)
 
-client = Groq(
-    api_key=os.environ.get("GROQ_API_KEY"),
-)
-index = ingest.load_index()
+# Seconds between checks of DATA_PATH for changed documents; 0 turns the checks off
+DATA_REFRESH_INTERVAL = float(os.getenv("DATA_REFRESH_INTERVAL", "60"))
 
+
+# The search index, the Groq clients and the caches are created on first use, so importing
+# this module is cheap; preload() creates what workers can share before gunicorn forks them
+
+def create_client():
+    if fakes.FAKE_SERVICES == "replay":
+        return fakes.FakeGroq()
+    from groq import Groq
+    return Groq(
+        api_key=os.environ.get("GROQ_API_KEY"),
+    )
+
+
+def create_async_client():
+    # Used by the async serving mode (app_async.py), where requests share one event loop
+    if fakes.FAKE_SERVICES == "replay":
+        return fakes.AsyncFakeGroq()
+    from groq import AsyncGroq
+    return AsyncGroq(
+        api_key=os.environ.get("GROQ_API_KEY"),
+    )
+
+
+get_client = Lazy(create_client)
+get_async_client = Lazy(create_async_client)
+
+BOOST = ingest.BOOST
+
+
+def load_search_index():
+    import minsearch
+    # The boosts are folded into the index when it is built, so searching with them is free.
+    # Documents changed while serving are merged in on a background thread without blocking searches.
+    return minsearch.SegmentedIndex(ingest.load_index(boost_dict=BOOST))
+
+
+search_index = Lazy(load_search_index)
+
+
+class DataRefresher:
+    """
+    Keeps the search index in step with the documents in data_path, without a restart.
+
+    Every interval seconds a background thread checks whether the file changed. If it did,
+    documents that changed or are new are upserted and those no longer in the file are
+    deleted. Every gunicorn worker runs its own thread against the same file, so all of them
+    converge on it, and the file, not a running index, keeps the documents across restarts.
+
+    Documents are identified as ingest.load_documents identifies them: by the file's id column
+    if it has one, and by their row otherwise. Without an id column the file must only be
+    appended to or edited in place, since inserting or removing a row changes the id of every
+    row after it, and all of those would be reindexed.
+    """
+
+    def __init__(self, data_path=ingest.DATA_PATH, interval=DATA_REFRESH_INTERVAL):
+        self.data_path = data_path
+        self.interval = interval
+        self.mtime = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        # Threads do not survive fork, so each worker starts its own on first use
+        if self.interval <= 0 or (self._thread is not None and self._thread.is_alive()):
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="data-refresh", daemon=True)
+                self._thread.start()
+
+    def refresh(self):
+        """
+        Applies the changes in data_path since the last refresh to the index.
+
+        Returns:
+            bool: Whether the file had changed.
+        """
+        mtime = os.path.getmtime(self.data_path)
+        if mtime == self.mtime:
+            return False
+
+        # The digest holds a hash of every indexed document. The index may have been prebuilt
+        # from an older file, so the first check compares the file with what it was loaded with.
+        indexed = corpus_digest().hashes
+        documents = ingest.load_documents(self.data_path)
+        changed = [doc for doc in documents if indexed.get(doc["id"]) != CorpusDigest.hash(doc)]
+        removed = indexed.keys() - {doc["id"] for doc in documents}
+        upsert_documents(changed)
+        for doc_id in removed:
+            delete_document(doc_id)
+
+        self.mtime = mtime
+        if changed or removed:
+            logger.info("Refreshed %d changed and %d removed documents from %s", len(changed), len(removed),
+                        self.data_path)
+        return True
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Refreshing documents from %s failed", self.data_path)
+            sleep(self.interval)
+
+
+data_refresher = DataRefresher()
+
+
+def get_index():
+    # Threads do not survive fork, so each worker starts its own merge and refresh threads on first use
+    index = search_index().start()
+    data_refresher.start()
+    return index
+
+
+class CorpusDigest:
+    """
+    A digest of the indexed documents that does not depend on their order or history.
+
+    It is the sum of a hash of every document, so upserting or deleting a document updates
+    it without hashing the others again, equal sets of documents get the same digest however
+    they came about, and different sets get different ones.
+    """
+
+    MODULUS = 2 ** 128
+
+    def __init__(self, documents):
+        self.hashes = {doc["id"]: self.hash(doc) for doc in documents}
+        self.total = sum(self.hashes.values()) % self.MODULUS
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def hash(doc):
+        key = json.dumps(doc, sort_keys=True, default=str)
+        return int.from_bytes(hashlib.sha256(key.encode("utf-8")).digest()[:16], "big")
+
+    def upsert(self, doc):
+        doc_hash = self.hash(doc)
+        with self._lock:
+            self.total = (self.total - self.hashes.get(doc["id"], 0) + doc_hash) % self.MODULUS
+            self.hashes[doc["id"]] = doc_hash
+
+    def delete(self, doc_id):
+        with self._lock:
+            self.total = (self.total - self.hashes.pop(doc_id, 0)) % self.MODULUS
+
+    def hexdigest(self):
+        return f"{self.total:032x}"[:16]
+
+
+def create_corpus_digest():
+    # Answers depend on the documents, so cached ones are keyed on the corpus they came from
+    index = search_index().index
+    return CorpusDigest(doc for doc, live in zip(index.docs, index.live) if live)
+
+
+corpus_digest = Lazy(create_corpus_digest)
+
+
+def create_semantic_cache():
+    if not cache.SEMANTIC_CACHE:
+        return None
+    # The sentence embedding model the preference classifier uses
+    from preferences.classification import encode
+    return cache.SemanticCache(encode)
+
+
+answer_cache = Lazy(cache.create_answer_cache)
+semantic_cache = Lazy(create_semantic_cache)
+
+
+def answer_caches():
+    # Exact repeats are cheapest to find, so they are looked up first
+    return [layer for layer in (answer_cache(), semantic_cache()) if layer is not None]
+
+
+def corpus_version():
+    return corpus_digest().hexdigest()
+
+
+def preload():
+    # Run in the gunicorn master with --preload: the workers forked from it share the index
+    # and the models copy-on-write instead of loading their own. Threads and connections do
+    # not survive fork, so the merge thread and the Groq clients are left to each worker.
+    search_index()
+    corpus_digest()
+    answer_caches()
+    if cache.SEMANTIC_CACHE:
+        from preferences.classification import get_model
+        get_model()
+    # Keep the garbage collector from writing to, and so copying, the preloaded objects
+    gc.freeze()
+
+
+@metrics.timed("minsearch_improved")
 def minsearch_improved(query):
-    boost = {'destination': 2.485673359952678,
-  'user_review': 2.9196237991381584,
-  'travel_tip': 1.9014614654735604,
-  'best_time_to_visit': 0.2946106215502525,
-  'local_cuisine_highlights': 1.6224280634698078,
-  'location_coordinates': 0.7452008126129724,
-  'popular_attractions': 2.5540130530716985,
-  'transportation_options': 1.4757377423401572,
-  'language_spoken': 0.05435765500930245,
-  'activities_available': 1.210048239340701,
-  'cultural_highlights': 2.886085497384669}
-    results = index.search(
+    results = get_index().search(
         query=query,
         filter_dict={},
-        boost_dict=boost,
+        boost_dict=BOOST,
         num_results=10
     )
 
     return results
 
 
+def upsert_documents(documents):
+    # Documents already indexed are replaced and the rest added, all together in one segment
+    get_index().upsert(documents)
+    for doc in documents:
+        corpus_digest().upsert(doc)
+
+
+def delete_document(doc_id):
+    get_index().delete(doc_id)
+    corpus_digest().delete(doc_id)
+
+
 prompt_template = """
 You're a travel expert. Answer the QUESTION based on the CONTEXT from our exercises database.
 Use only the facts from the CONTEXT when answering the QUESTION.
@@ -42,47 +245,187 @@ CONTEXT:
 {context}
 """.strip()
 
-entry_template = """
-destination: {destination}
-user_review: {user_review}
-travel_tip: {travel_tip}
-best_time_to_visit: {best_time_to_visit}
-local_cuisine_highlights: {local_cuisine_highlights}
-location_coordinates: {location_coordinates}
-popular_attractions: {popular_attractions}
-transportation_options: {transportation_options}
-language_spoken: {language_spoken}
-activities_available: {activities_available}
-cultural_highlights: {cultural_highlights}
+# Fields given to the model for each document, in the order they appear in the prompt
+context_fields = [
+    'user_review',
+    'travel_tip',
+    'best_time_to_visit',
+    'local_cuisine_highlights',
+    'location_coordinates',
+    'popular_attractions',
+    'transportation_options',
+    'language_spoken',
+    'activities_available',
+    'cultural_highlights',
+]
+
+# Tokens the documents in the prompt may take. On the questions of rag-eval-llama70b.csv this
+# cuts prompt tokens by about a third and keeps 99% of the words the recorded answers drew on
+# (see evaluate_context.py)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "800"))
+
+
+def estimate_tokens(text):
+    # Close enough to the model's tokenizer for budgeting: about four characters a token
+    return len(text) // 4 + 1
+
+
+def search_field_scores(query, search_results):
+    # How much each field of each result matched the query, as {field: score} per result
+    index = get_index()
+    scores = index.field_scores(query, [doc["id"] for doc in search_results], boost_dict=BOOST)
+    return [dict(zip(index.index.text_fields, row)) for row in scores]
+
+
+def build_context(search_results, field_scores, budget=CONTEXT_TOKEN_BUDGET):
+    """
+    Builds the CONTEXT of the prompt from the search results within a token budget.
+
+    Every field of every document is one line. Lines of fields that matched the query go in
+    first, best match first; then the other fields of the best ranked documents, their most
+    boosted fields first, until the budget is used up. A line already given for the same
+    destination is left out, and each destination is named once, above its documents.
+
+    Args:
+        search_results (list of dict): Documents, best first.
+        field_scores (list of dict): For each document, each field's contribution to its score.
+        budget (int): Estimated tokens the context may take; None for no limit.
+
+    Returns:
+        str: The context, documents in search order and fields in context_fields order.
+    """
+    candidates = []
+    for rank, (doc, scores) in enumerate(zip(search_results, field_scores)):
+        for field in context_fields:
+            value = doc.get(field)
+            if value is None or value != value or value == "":
+                continue
+            score = scores.get(field, 0)
+            priority = (score <= 0, -score, rank, -BOOST.get(field, 0))
+            candidates.append((priority, rank, field, f"{field}: {value}"))
+    candidates.sort(key=lambda candidate: candidate[0])
+
+    destinations = [doc.get("destination", "") for doc in search_results]
+    chosen = set()
+    given = set()
+    named = set()
+    used = 0
+    for _, rank, field, line in candidates:
+        destination = destinations[rank]
+        if (destination, line) in given:
+            continue
+        cost = estimate_tokens(line)
+        if destination not in named:
+            cost += estimate_tokens(f"destination: {destination}")
+        if budget is not None and used + cost > budget:
+            continue
+        used += cost
+        chosen.add((rank, field))
+        given.add((destination, line))
+        named.add(destination)
+
+    # Documents of one destination are listed together, under the first one's position
+    blocks = {}
+    for rank, doc in enumerate(search_results):
+        lines = [f"{field}: {doc[field]}" for field in context_fields if (rank, field) in chosen]
+        if lines:
+            blocks.setdefault(destinations[rank], []).append("\n".join(lines))
+
+    return "\n\n".join(
+        f"destination: {destination}\n" + "\n\n".join(documents)
+        for destination, documents in blocks.items()
+    )
+
 
+@metrics.timed("build_prompt")
+def build_prompt(query, search_results, budget=CONTEXT_TOKEN_BUDGET):
+    context = build_context(search_results, search_field_scores(query, search_results), budget)
+    return prompt_template.format(question=query, context=context).strip()
 
-""".strip()
 
-def build_prompt(query, search_results):
-    context = ""
+def parse_usage(usage):
+    if usage is None:
+        return {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+
+    return {
+        "prompt_tokens": usage.prompt_tokens,
+        "completion_tokens": usage.completion_tokens,
+        "total_tokens": usage.total_tokens,
+    }
+
+
+def parse_response(response):
+    token_stats = parse_usage(response.usage)
     
-    for doc in search_results:
-        context = context + entry_template.format(**doc) + "\n\n"
+    answer = response.choices[0].message.content
+    return answer, token_stats
+
 
-    prompt = prompt_template.format(question=query, context=context).strip()
-    return prompt
+def stream_usage(chunk):
+    # Groq reports the token usage of a streamed completion on its last chunk, under x_groq
+    x_groq = getattr(chunk, "x_groq", None)
+    return getattr(x_groq, "usage", None)
 
 
-def llm(prompt, model='llama3-8b-8192'):
-    response = client.chat.completions.create(
+def llm(prompt, model='llama3-8b-8192', stage="llm"):
+    # stage labels the call in the metrics, so the judge's calls are kept apart from answers
+    with metrics.timer(stage):
+        response = get_client().chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": prompt}]
+        )
+    answer, token_stats = parse_response(response)
+    metrics.record_tokens(model, token_stats)
+    return answer, token_stats
+
+
+@metrics.timed("llm")
+async def llm_async(prompt, model='llama3-8b-8192'):
+    response = await get_async_client().chat.completions.create(
         model=model,
         messages=[{"role": "user", "content": prompt}]
     )
-    token_stats = {
-        "prompt_tokens": response.usage.prompt_tokens,
-        "completion_tokens": response.usage.completion_tokens,
-        "total_tokens": response.usage.total_tokens,
-    }
-    
-    answer = response.choices[0].message.content
+    answer, token_stats = parse_response(response)
+    metrics.record_tokens(model, token_stats)
     return answer, token_stats
 
 
+def llm_stream(prompt, model='llama3-8b-8192'):
+    # Yields ("token", text) as the answer is generated, then ("usage", token_stats).
+    # The llm stage lasts until the last chunk, including the time the caller takes per token.
+    with metrics.timer("llm"):
+        stream = get_client().chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": prompt}],
+            stream=True,
+        )
+        usage = None
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield "token", chunk.choices[0].delta.content
+            usage = stream_usage(chunk) or usage
+    token_stats = parse_usage(usage)
+    metrics.record_tokens(model, token_stats)
+    yield "usage", token_stats
+
+
+async def llm_stream_async(prompt, model='llama3-8b-8192'):
+    with metrics.timer("llm"):
+        stream = await get_async_client().chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": prompt}],
+            stream=True,
+        )
+        usage = None
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield "token", chunk.choices[0].delta.content
+            usage = stream_usage(chunk) or usage
+    token_stats = parse_usage(usage)
+    metrics.record_tokens(model, token_stats)
+    yield "usage", token_stats
+
+
 evaluation_prompt_template = """
 You are an expert evaluator for a RAG system.
 Your task is to analyze the relevance of the generated answer to the given question.
@@ -104,10 +447,7 @@ and provide your evaluation in parsable JSON without using code blocks:
 """.strip()
 
 
-def evaluate_relevance(question, answer):
-    prompt = evaluation_prompt_template.format(question=question, answer=answer)
-    evaluation, tokens = llm(prompt, model="llama3-8b-8192")
-
+def parse_evaluation(evaluation, tokens):
     try:
         json_eval = json.loads(evaluation)
         return json_eval, tokens
@@ -116,6 +456,68 @@ def evaluate_relevance(question, answer):
         return result, tokens
 
 
+@metrics.timed("evaluate_relevance")
+def evaluate_relevance(question, answer):
+    prompt = evaluation_prompt_template.format(question=question, answer=answer)
+    evaluation, tokens = llm(prompt, model="llama3-8b-8192", stage="judge_llm")
+    return parse_evaluation(evaluation, tokens)
+
+
+batch_evaluation_prompt_template = """
+You are an expert evaluator for a RAG system.
+Your task is to analyze the relevance of each generated answer to its question.
+Based on the relevance of a generated answer, you will classify it
+as "NON_RELEVANT", "PARTLY_RELEVANT", or "RELEVANT".
+
+Here are the numbered question and answer pairs for evaluation:
+
+{pairs}
+
+Please analyze the content and context of each generated answer in relation to its question
+and provide your evaluations in parsable JSON without using code blocks, as a list with
+one evaluation per pair, in the same order:
+
+[
+  {{
+    "Relevance": "NON_RELEVANT" | "PARTLY_RELEVANT" | "RELEVANT",
+    "Explanation": "[Provide a brief explanation for your evaluation]"
+  }}
+]
+""".strip()
+
+pair_template = """
+{number}.
+Question: {question}
+Generated Answer: {answer}
+""".strip()
+
+
+@metrics.timed("evaluate_relevance_batch")
+def evaluate_relevance_batch(pairs):
+    # One judge call for several (question, answer) pairs; tokens are for the whole call
+    if len(pairs) == 1:
+        evaluation, tokens = evaluate_relevance(*pairs[0])
+        return [evaluation], tokens
+
+    text = "\n\n".join(
+        pair_template.format(number=number, question=question, answer=answer)
+        for number, (question, answer) in enumerate(pairs, 1)
+    )
+    prompt = batch_evaluation_prompt_template.format(pairs=text)
+    evaluations, tokens = llm(prompt, model="llama3-8b-8192", stage="judge_llm")
+
+    try:
+        json_evals = json.loads(evaluations)
+    except json.JSONDecodeError:
+        json_evals = None
+    if (not isinstance(json_evals, list) or len(json_evals) != len(pairs)
+            or not all(isinstance(json_eval, dict) for json_eval in json_evals)):
+        result = {"Relevance": "UNKNOWN", "Explanation": "Failed to parse evaluation"}
+        return [result] * len(pairs), tokens
+
+    return json_evals, tokens
+
+
 def calculate_openai_cost(model, tokens):
     groqapi_cost = 0
 
@@ -129,37 +531,174 @@ def calculate_openai_cost(model, tokens):
     return groqapi_cost
 
 
+def cached_answer(query, model, version, t0):
+    for layer in answer_caches():
+        answer_data = layer.get(query, model, version)
+        metrics.cache_lookups.inc(layer=layer.name, result="miss" if answer_data is None else "hit")
+        if answer_data is not None:
+            break
+    else:
+        return None
+
+    # Serving a cached answer costs no tokens, and it was already judged when first given
+    took = time() - t0
+    return {
+        **answer_data,
+        "response_time": took,
+        "time_to_first_token": took,
+        "tokens_per_second": None,
+        "relevance": "NOT_EVALUATED",
+        "relevance_explanation": "Answer served from cache",
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "total_tokens": 0,
+        "openai_cost": 0,
+        "cached": True,
+    }
+
+
+def cache_answer(query, model, version, answer_data):
+    for layer in answer_caches():
+        layer.set(query, model, version, dict(answer_data))
+
+
+def cache_stats():
+    return {
+        name: {"enabled": True, **layer.stats()} if layer is not None else {"enabled": False}
+        for name, layer in (("exact", answer_cache()), ("semantic", semantic_cache()))
+    }
+
+
+class RagCall:
+    """
+    The steps rag(), rag_async(), rag_stream() and rag_stream_async() share, so that they only
+    differ in how they call the LLM.
+
+    Creating a call looks the question up in the answer caches: cached is the answer found,
+    or None. Otherwise prompt() searches and builds the prompt, and finish() turns the LLM's
+    answer into answer_data and caches it; a streamed answer is collected with collect() as
+    it arrives and finished with finish_stream().
+    """
+
+    def __init__(self, query, model):
+        self.query = query
+        self.model = model
+        self.t0 = time()
+        self.version = corpus_version()
+        self.cached = cached_answer(query, model, self.version, self.t0)
+        self.t_llm = None
+        self.pieces = []
+        self.first_token = None
+        self.token_stats = None
+
+    def prompt(self):
+        # Searching takes well under a millisecond, so the async paths run it on the event loop
+        search_results = minsearch_improved(self.query)
+        prompt = build_prompt(self.query, search_results)
+        self.t_llm = time()
+        return prompt
+
+    def collect(self, kind, value):
+        """Records an item of llm_stream(); returns whether it is a token to pass on."""
+        if kind == "usage":
+            self.token_stats = value
+            return False
+        if self.first_token is None:
+            self.first_token = time()
+        self.pieces.append(value)
+        return True
+
+    def finish(self, answer, token_stats):
+        # Without streaming, the first token reaches the user with the whole answer
+        t1 = time()
+        return self._answer_data(answer, token_stats, t1, t1 - self.t0, t1 - self.t_llm)
+
+    def finish_stream(self):
+        t1 = time()
+        first_token = self.first_token or t1
+        metrics.observe_stage("llm_first_token", first_token - self.t_llm)
+        return self._answer_data("".join(self.pieces), self.token_stats, t1, first_token - self.t0, t1 - first_token)
+
+    def _answer_data(self, answer, token_stats, t1, time_to_first_token, generation_time):
+        # Relevance is judged later, off the request path (see judge.py)
+        answer_data = make_answer_data(self.model, answer, token_stats, t1 - self.t0, time_to_first_token,
+                                       generation_time)
+        cache_answer(self.query, self.model, self.version, answer_data)
+        return answer_data
+
+
 def rag(query, model="llama3-8b-8192"):
-    t0 = time()
+    call = RagCall(query, model)
+    if call.cached is not None:
+        return call.cached
+
+    answer, token_stats = llm(call.prompt(), model=model)
+    return call.finish(answer, token_stats)
+
+
+async def rag_async(query, model="llama3-8b-8192"):
+    call = RagCall(query, model)
+    if call.cached is not None:
+        return call.cached
+
+    answer, token_stats = await llm_async(call.prompt(), model=model)
+    return call.finish(answer, token_stats)
+
+
+def rag_stream(query, model="llama3-8b-8192"):
+    """
+    Like rag(), but yields ("token", text) as the answer is generated, then ("answer", answer_data)
+    once it is complete.
+    """
+    call = RagCall(query, model)
+    if call.cached is not None:
+        yield "token", call.cached["answer"]
+        yield "answer", call.cached
+        return
+
+    for kind, value in llm_stream(call.prompt(), model=model):
+        if call.collect(kind, value):
+            yield kind, value
+
+    yield "answer", call.finish_stream()
+
 
-    search_results = minsearch_improved(query)
-    prompt = build_prompt(query, search_results)
-    answer, token_stats = llm(prompt, model=model)
+async def rag_stream_async(query, model="llama3-8b-8192"):
+    call = RagCall(query, model)
+    if call.cached is not None:
+        yield "token", call.cached["answer"]
+        yield "answer", call.cached
+        return
 
-    relevance, rel_token_stats = evaluate_relevance(query, answer)
+    async for kind, value in llm_stream_async(call.prompt(), model=model):
+        if call.collect(kind, value):
+            yield kind, value
 
-    t1 = time()
-    took = t1 - t0
+    yield "answer", call.finish_stream()
 
-    openai_cost_rag = calculate_openai_cost(model, token_stats)
-    openai_cost_eval = calculate_openai_cost(model, rel_token_stats)
 
-    openai_cost = openai_cost_rag + openai_cost_eval
+def make_answer_data(model, answer, token_stats, took, time_to_first_token, generation_time):
+    # time_to_first_token is how long the user waited before the answer started to appear;
+    # generation_time is how long the model took to generate the answer
+    metrics.observe_stage("rag", took)
+    openai_cost = calculate_openai_cost(model, token_stats)
+    tokens_per_second = token_stats["completion_tokens"] / generation_time if generation_time > 0 else None
 
+    # The relevance judge fills in the relevance and eval_* fields and adds its cost later
     answer_data = {
         "answer": answer,
         "model_used": model,
         "response_time": took,
-        "relevance": relevance.get("Relevance", "UNKNOWN"),
-        "relevance_explanation": relevance.get(
-            "Explanation", "Failed to parse evaluation"
-        ),
+        "time_to_first_token": time_to_first_token,
+        "tokens_per_second": tokens_per_second,
+        "relevance": "PENDING",
+        "relevance_explanation": "Waiting for evaluation",
         "prompt_tokens": token_stats["prompt_tokens"],
         "completion_tokens": token_stats["completion_tokens"],
         "total_tokens": token_stats["total_tokens"],
-        "eval_prompt_tokens": rel_token_stats["prompt_tokens"],
-        "eval_completion_tokens": rel_token_stats["completion_tokens"],
-        "eval_total_tokens": rel_token_stats["total_tokens"],
+        "eval_prompt_tokens": 0,
+        "eval_completion_tokens": 0,
+        "eval_total_tokens": 0,
         "openai_cost": openai_cost,
     }
 
@@ -0,0 +1,32 @@
+import json
+
+import db
+from judge import relevance_judge
+
+# What the sync (app.py) and async (app_async.py) apps do the same way around an answer
+
+
+def save_answer(conversation_id, question, answer_data):
+    evaluate = relevance_judge.sample(answer_data)
+
+    db.writer.save_conversation(
+        conversation_id=conversation_id,
+        question=question,
+        answer_data=answer_data,
+    )
+
+    if evaluate:
+        relevance_judge.submit(conversation_id, question, answer_data["answer"])
+
+
+def answer_result(conversation_id, question, answer_data):
+    # The body of /question, and the data of the "done" event of /question/stream
+    return {
+        "conversation_id": conversation_id,
+        "question": question,
+        "answer": answer_data["answer"],
+    }
+
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
@@ -0,0 +1,162 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+import ingest
+
+# Tunes the field boosts of the search on the ground-truth questions and writes the best ones
+# to ingest.BOOST_PATH, where the app picks them up on its next start:
+#   python tune_boost.py                          random search, then refine around the best
+#   python tune_boost.py --metric hit_rate --iterations 5000 --workers 8
+# The per-field similarities of every question to every document are computed once; a
+# candidate's ranking is then their weighted sum, so each candidate costs one small mat-vec
+# per question instead of a search. Candidates are picked on a training split of the
+# questions and compared on the held-out rest.
+
+MIN_BOOST = 0.01
+CHUNK_SIZE = 50
+
+# Set in each worker by init_worker, so the tensor is sent once per process, not per candidate
+similarities = None
+target_rows = None
+train = None
+num_results = None
+
+
+def init_worker(worker_similarities, worker_target_rows, worker_train, worker_num_results):
+    global similarities, target_rows, train, num_results
+    similarities = worker_similarities
+    target_rows = worker_target_rows
+    train = worker_train
+    num_results = worker_num_results
+
+
+def evaluate(candidates):
+    """
+    Hit rate and MRR of each boost vector on the training and validation questions.
+
+    A question's rank is the rank search() would give its document: documents with a higher
+    score come first, and ties go to the earlier row. Documents scoring 0 are not returned.
+    """
+    rows = np.arange(similarities.shape[1])
+    questions = np.arange(len(target_rows))
+    results = []
+    for boosts in candidates:
+        scores = similarities @ boosts
+        target_scores = scores[questions, target_rows][:, None]
+        rank = ((scores > target_scores) | ((scores == target_scores) & (rows < target_rows[:, None]))).sum(axis=1)
+        hit = (target_scores[:, 0] > 0) & (rank < num_results)
+        reciprocal_rank = np.where(hit, 1 / (rank + 1), 0.0)
+        results.append({
+            split: {"hit_rate": float(hit[mask].mean()), "mrr": float(reciprocal_rank[mask].mean())}
+            for split, mask in (("train", train), ("validation", ~train))
+        })
+    return results
+
+
+def evaluate_all(executor, candidates):
+    chunks = [candidates[i:i + CHUNK_SIZE] for i in range(0, len(candidates), CHUNK_SIZE)]
+    return [result for chunk in executor.map(evaluate, chunks) for result in chunk]
+
+
+def boost_vector(boost_dict, fields):
+    return np.array([boost_dict.get(field, 1.0) for field in fields])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune the field boosts of the search")
+    parser.add_argument("--data", default=ingest.SCRIPT_DATA_PATH)
+    parser.add_argument("--ground-truth", default=ingest.GROUND_TRUTH_PATH)
+    parser.add_argument("--metric", choices=["mrr", "hit_rate"], default="mrr", help="what to maximize")
+    parser.add_argument("--num-results", type=int, default=10, help="the k of hit rate and MRR")
+    parser.add_argument("--iterations", type=int, default=2000, help="candidates per round")
+    parser.add_argument("--rounds", type=int, default=3, help="rounds of refinement after the random search")
+    parser.add_argument("--max-boost", type=float, default=3.0, help="boosts are searched in [0.01, max-boost]")
+    parser.add_argument("--validation", type=float, default=0.2, help="share of the questions held out")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes evaluating candidates")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=ingest.BOOST_PATH, help="JSON file to write the best boosts to")
+    parser.add_argument("--dry-run", action="store_true", help="report the best boosts without writing them")
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    documents = ingest.load_documents(args.data)
+    index = ingest.fit_index(documents)
+    fields = index.text_fields
+
+    ground_truth = pd.read_csv(args.ground_truth)
+    ground_truth = ground_truth[ground_truth["id"].isin(index.id_rows)]
+    rng = np.random.default_rng(args.seed)
+    train_mask = rng.random(len(ground_truth)) >= args.validation
+
+    tensor = index.field_similarities(ground_truth["question"].tolist())
+    question_rows = np.array([index.id_rows[doc_id] for doc_id in ground_truth["id"]])
+    print(f"{len(ground_truth)} questions ({train_mask.sum()} for training), {len(documents)} documents, "
+          f"{len(fields)} fields: similarities computed in {time.perf_counter() - t0:.1f}s")
+
+    # Globals of this process too, so the baselines below can be evaluated without the pool
+    init_worker(tensor, question_rows, train_mask, args.num_results)
+    baselines = {
+        "current": evaluate([boost_vector(ingest.BOOST, fields)])[0],
+        "unboosted": evaluate([np.ones(len(fields))])[0],
+    }
+
+    t0 = time.perf_counter()
+    evaluated = []
+    initargs = (tensor, question_rows, train_mask, args.num_results)
+    with ProcessPoolExecutor(args.workers, initializer=init_worker, initargs=initargs) as executor:
+        candidates = list(rng.uniform(MIN_BOOST, args.max_boost, (args.iterations, len(fields))))
+        candidates.append(boost_vector(ingest.BOOST, fields))
+        evaluated += zip(candidates, evaluate_all(executor, candidates))
+
+        # Each round perturbs the best candidates so far, in ever smaller steps
+        step = 0.5
+        for _ in range(args.rounds):
+            evaluated.sort(key=lambda item: -item[1]["train"][args.metric])
+            parents = [boosts for boosts, _ in evaluated[:10]]
+            candidates = [
+                np.clip(parents[i % len(parents)] * np.exp(rng.normal(0, step, len(fields))), MIN_BOOST, args.max_boost)
+                for i in range(args.iterations)
+            ]
+            evaluated += zip(candidates, evaluate_all(executor, candidates))
+            step /= 2
+
+    evaluated.sort(key=lambda item: -item[1]["train"][args.metric])
+    best_boosts, best = evaluated[0]
+    took = time.perf_counter() - t0
+    print(f"{len(evaluated)} candidates in {took:.1f}s ({len(evaluated) / took:.0f}/s on {args.workers} workers)")
+
+    for name, result in (("unboosted", baselines["unboosted"]), ("current", baselines["current"]), ("best", best)):
+        print(f"{name:<10} " + ", ".join(
+            f"{split} hit rate {result[split]['hit_rate']:.3f} MRR {result[split]['mrr']:.3f}"
+            for split in ("train", "validation")
+        ))
+
+    boost = {field: float(value) for field, value in zip(fields, best_boosts)}
+    if args.dry_run:
+        print(json.dumps(boost, indent=2))
+    else:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump({
+                "boost": boost,
+                "metric": args.metric,
+                "num_results": args.num_results,
+                "train": best["train"],
+                "validation": best["validation"],
+                "baseline": baselines["current"],
+                "data": args.data,
+                "ground_truth": args.ground_truth,
+                "tuned_at": datetime.now(timezone.utc).isoformat(),
+            }, f, indent=2)
+        print(f"Wrote the best boosts to {args.output}")
+
+
+if __name__ == "__main__":
+    main()